@@ -0,0 +1,244 @@
+"""
+Benchmark for the measure -> queue -> upload pipeline of main.py.
+
+Runs main.py in a temporary directory with a synthetic sensor package against a local stand-in API
+and reports throughput, end-to-end latency and resource usage of the collector process.
+
+Usage: python benchmarks/pipeline.py --sensors 200 --interval 1s --duration 30s
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+from threading import Lock, Thread
+import time
+from typing import Any
+import uuid
+
+import psutil
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from core.util import parse_interval
+
+SENSOR_PACKAGE = '''
+import time
+
+from core.classes import Measurement, Metric, SensorBase, SensorDef, SettingsBase, Status
+
+class BenchSettings(SettingsBase):
+    def __init__(self, metrics: int, latency: float) -> None:
+        self.metrics = metrics
+        self.latency = latency
+
+    @classmethod
+    def deserialize(cls, conf):
+        return cls(conf['metrics'].as_int(), conf['latency'].as_float())
+
+class BenchSensor(SensorBase[BenchSettings]):
+    def __init__(self, settings: BenchSettings) -> None:
+        self.settings = settings
+        self.names = [f'metric{i}' for i in range(settings.metrics)]
+        self.count = 0
+
+    def measure(self) -> Measurement:
+        if self.settings.latency > 0:
+            time.sleep(self.settings.latency)
+        self.count += 1
+        return Measurement.now(Status.HEALTHY, [Metric(name, 'unit', self.count + i) for i, name in enumerate(self.names)])
+
+SENSORS = [
+    SensorDef('sensor', BenchSensor, BenchSettings),
+]
+'''
+
+class Stats:
+    """
+    Requests and measurements received by the stand-in API
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.measurements = 0
+        self.latencies = list[float]()
+
+    def record(self, size: int, items: list[dict[str, Any]]) -> None:
+        now = time.time()
+        latencies = [now - datetime.fromisoformat(item['time']).timestamp() for item in items]
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            self.measurements += len(items)
+            self.latencies.extend(latencies)
+
+def serve(stats: Stats) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _handle(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            size = len(body)
+            encoding = self.headers.get('Content-Encoding')
+            if encoding == 'gzip':
+                body = gzip.decompress(body)
+            elif encoding == 'zstd':
+                import zstandard # type: ignore
+                body = zstandard.ZstdDecompressor().decompress(body)
+
+            if self.command == 'POST' and self.path.startswith('/Collector'):
+                data = json.loads(body)
+                stats.record(size, data if isinstance(data, list) else [data])
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        do_POST = do_PATCH = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def main():
+    parser = ArgumentParser(description='Benchmark the measure -> queue -> upload pipeline')
+    parser.add_argument('--sensors', type=int, default=100, help='Number of sensors')
+    parser.add_argument('--interval', default='1s', help='Sensor interval')
+    parser.add_argument('--metrics', type=int, default=5, help='Metrics per measurement')
+    parser.add_argument('--latency', type=float, default=0, help='Duration of a measurement in seconds')
+    parser.add_argument('--duration', default='30s', help='Benchmark duration')
+    parser.add_argument('--upload', default='2s', help='Upload interval (upload.min_interval)')
+    parser.add_argument('--workers', type=int, default=8, help='Measurement threads')
+    parser.add_argument('--batch-size', type=int, default=100, help='upload.batch_size')
+    parser.add_argument('--engine', default='sync', choices=['sync', 'async'], help='upload.engine')
+    parser.add_argument('--compression', default='none', choices=['none', 'gzip', 'zstd'], help='upload.compression')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    duration = parse_interval(args.duration)
+    stats = Stats()
+    server = serve(stats)
+
+    with tempfile.TemporaryDirectory(prefix='insights-bench-') as run:
+        shutil.copytree(os.path.join(ROOT, 'core'), os.path.join(run, 'core'))
+        shutil.copytree(os.path.join(ROOT, 'schemas'), os.path.join(run, 'schemas'))
+        shutil.copyfile(os.path.join(ROOT, 'main.py'), os.path.join(run, 'main.py'))
+        os.makedirs(os.path.join(run, 'packages', 'bench', 'sensors'))
+        with open(os.path.join(run, 'packages', 'bench', 'sensors', '__init__.py'), 'wt') as f:
+            f.write(SENSOR_PACKAGE)
+
+        settings = {
+            'uuid': str(uuid.uuid4()),
+            'name': 'bench',
+            'url': f'http://127.0.0.1:{server.server_address[1]}',
+            'token': 'bench',
+            'workers': args.workers,
+            'upload': {
+                'min_interval': args.upload,
+                'max_interval': '5m',
+                'max_backlog': 1_000_000,
+                'batch_size': args.batch_size,
+                'engine': args.engine,
+                'compression': args.compression,
+                'spool_max_bytes': 0,
+            },
+            'sensors': [
+                {
+                    'uuid': str(uuid.uuid4()),
+                    'type': 'bench:sensor',
+                    'name': f'sensor {i}',
+                    'interval': args.interval,
+                    'settings': {'metrics': args.metrics, 'latency': args.latency},
+                }
+                for i in range(args.sensors)
+            ],
+        }
+        settings_path = os.path.join(run, 'settings.json')
+        with open(settings_path, 'wt') as f:
+            json.dump(settings, f)
+
+        log = open(os.path.join(run, 'main.log'), 'w+t')
+        proc = subprocess.Popen(
+            (sys.executable, 'main.py', settings_path, 'normal'),
+            cwd=run, stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+        )
+        process = psutil.Process(proc.pid)
+
+        start = time.monotonic()
+        rss = list[int]()
+        try:
+            cpu_start = process.cpu_times()
+            while time.monotonic() - start < duration and proc.poll() is None:
+                rss.append(process.memory_info().rss)
+                time.sleep(0.5)
+            if proc.poll() is not None:
+                raise psutil.NoSuchProcess(proc.pid)
+            cpu = process.cpu_times()
+        except psutil.NoSuchProcess:
+            # e.g. invalid settings, the log tells why
+            proc.wait()
+            log.seek(0)
+            print(log.read(), file=sys.stderr)
+            raise RuntimeError(f'main.py exited early with code {proc.returncode}')
+        elapsed = time.monotonic() - start
+        cpu_secs = (cpu.user - cpu_start.user) + (cpu.system - cpu_start.system)
+
+        with stats.lock:
+            requests, size, measurements = stats.requests, stats.bytes, stats.measurements
+            latencies = list(stats.latencies)
+
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(60)
+        log.seek(0)
+        output = log.read()
+        log.close()
+        if proc.returncode:
+            print(output, file=sys.stderr)
+            raise RuntimeError(f'main.py exited with code {proc.returncode}')
+
+    server.shutdown()
+
+    expected = args.sensors / parse_interval(args.interval) * elapsed
+    results = {
+        'duration_secs': elapsed,
+        'measurements': measurements,
+        'measurements_per_sec': measurements / elapsed,
+        'expected_per_sec': expected / elapsed,
+        'requests_per_sec': requests / elapsed,
+        'upload_bytes_per_sec': size / elapsed,
+        'latency_p50_secs': percentile(latencies, 0.5),
+        'latency_p90_secs': percentile(latencies, 0.9),
+        'latency_p99_secs': percentile(latencies, 0.99),
+        'latency_max_secs': max(latencies, default=float('nan')),
+        'cpu_percent': cpu_secs / elapsed * 100,
+        'rss_max_mb': max(rss, default=0) / 1024 / 1024,
+    }
+
+    if args.json:
+        print(json.dumps(results, indent='  '))
+        return
+    for key, value in results.items():
+        print(f'{key:<24}{value:>14.3f}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Client-side aggregation of measurements into fixed time windows
+"""
+
+from __future__ import annotations
+
+from typing import Any
+
+from core.classes import Measurement, Metric, Status
+
+FUNCTIONS = ('min', 'max', 'mean', 'last', 'count')
+
+# Higher is worse
+_SEVERITY = {
+    Status.UNSET: 0,
+    Status.HEALTHY: 1,
+    Status.UNKNOWN: 2,
+    Status.DEGRADED: 3,
+    Status.UNHEALTHY: 4,
+    Status.TIMEOUT: 5,
+    Status.ERROR: 6,
+}
+
+class _Series:
+    __slots__ = ('unit', 'min', 'max', 'sum', 'numeric', 'count', 'last')
+
+    def __init__(self, unit: str, value: Any) -> None:
+        self.unit = unit
+        self.min = self.max = value
+        self.sum = 0
+        self.numeric = 0
+        self.count = 0
+        self.last = value
+
+    def add(self, value: Any) -> None:
+        self.last = value
+        self.count += 1
+        if _numeric(value) and _numeric(self.min):
+            self.sum += value
+            self.numeric += 1
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+def _numeric(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+class Aggregator:
+    """
+    Rolls up the measurements of a sensor within a time window.
+    Numeric metrics are reduced to the configured functions, named `<metric>.<function>`.
+    `last` keeps the original metric name, non-numeric metrics only report their last value.
+    The status of a window is the worst status of its measurements
+    """
+
+    def __init__(self, window: float, functions: tuple[str, ...] = FUNCTIONS) -> None:
+        for function in functions:
+            if function not in FUNCTIONS:
+                raise ValueError(f'Unknown aggregate function {function!r}')
+        self.window = window
+        self.functions = functions
+        self._start: float | None = None
+        self._status = Status.UNSET
+        self._error: str | None = None
+        self._trace: list[str] | None = None
+        self._time = 0.0
+        self._series = dict[str, _Series]()
+
+    def add(self, value: Measurement) -> Measurement | None:
+        """
+        Add a measurement to the current window
+
+        :returns: The aggregate of the previous window if the measurement started a new one
+        """
+        start = value.timestamp - value.timestamp % self.window
+        result = None
+        if self._start is not None and start != self._start:
+            result = self._emit()
+
+        if self._start is None:
+            self._start = start
+            self._status = value.status
+        elif _SEVERITY.get(value.status, 0) >= _SEVERITY.get(self._status, 0):
+            self._status = value.status
+        if value.error is not None:
+            self._error = value.error
+            self._trace = value.trace
+        self._time = value.timestamp
+
+        for metric in value.metrics:
+            series = self._series.get(metric.name)
+            if series is None:
+                series = self._series[metric.name] = _Series(metric.unit, metric.value)
+            series.add(metric.value)
+        return result
+
+    def flush(self, now: float) -> Measurement | None:
+        """
+        :returns: The aggregate of the current window if it has ended
+        """
+        if self._start is None or now < self._start + self.window:
+            return None
+        return self._emit()
+
+    def _emit(self) -> Measurement:
+        metrics = []
+        for name, series in self._series.items():
+            if not _numeric(series.min):
+                metrics.append(Metric(name, series.unit, series.last))
+                continue
+            for function in self.functions:
+                match function:
+                    case 'min': metrics.append(Metric(name + '.min', series.unit, series.min))
+                    case 'max': metrics.append(Metric(name + '.max', series.unit, series.max))
+                    case 'mean': metrics.append(Metric(name + '.mean', series.unit, series.sum / series.numeric))
+                    case 'last': metrics.append(Metric(name, series.unit, series.last))
+                    case 'count': metrics.append(Metric(name + '.count', '', series.count))
+
+        result = Measurement.now(self._status, metrics, self._error, self._trace)
+        result.timestamp = self._time
+
+        self._start = None
+        self._status = Status.UNSET
+        self._error = None
+        self._trace = None
+        self._series = {}
+        return result
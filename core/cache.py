@@ -0,0 +1,138 @@
+"""
+Short-lived cache for expensive probes that several sensors read at about the same time,
+e.g. `psutil.process_iter()` or `psutil.disk_io_counters()`.
+
+Concurrent callers of an expired probe wait for a single call instead of all running it.
+Cached values are shared between sensors and must not be modified.
+Sensors running in worker processes have a cache per process
+"""
+
+from __future__ import annotations
+
+import functools
+from threading import Event, Lock
+import time
+from typing import Any, Callable, Hashable, ParamSpec, TypeVar
+
+from core.metrics import REGISTRY
+
+_T = TypeVar('_T')
+_P = ParamSpec('_P')
+
+class _Entry:
+    __slots__ = ('value', 'expires', 'loading')
+
+    def __init__(self) -> None:
+        self.value: Any = None
+        self.expires = 0.0
+        self.loading: Event | None = Event()
+        """Set once the running probe finished, None if there is none"""
+
+class SampleCache:
+    """
+    Probe results by key, each kept for the time to live passed to `get()`
+    """
+
+    PRUNE_SECS = 60
+
+    def __init__(self) -> None:
+        self._entries = dict[Hashable, _Entry]()
+        self._lock = Lock()
+        self._pruned = time.monotonic()
+        self.hits = REGISTRY.counter('cache_hits')
+        self.misses = REGISTRY.counter('cache_misses')
+
+    def get(self, key: Hashable, fn: Callable[[], _T], ttl: float = 1.0) -> _T:
+        """
+        Get a cached value, calling `fn` if there is none or it is older than `ttl` seconds.
+        If `fn` is already running for this key, wait for its result instead.
+        Exceptions are not cached
+
+        :param key: Identifies the probe and its arguments
+        :param fn: Performs the probe
+        :param ttl: Time to live in seconds
+        """
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None or (entry.loading is None and time.monotonic() >= entry.expires):
+                    entry = self._entries[key] = _Entry()
+                    loading = None
+                else:
+                    loading = entry.loading
+                    if loading is None:
+                        self.hits.inc()
+                        return entry.value
+            if loading is None:
+                break
+            loading.wait()
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    self.hits.inc()
+                    return entry.value
+            # The probe failed, try again
+
+        self.misses.inc()
+        event = entry.loading
+        assert event is not None
+        try:
+            entry.value = fn()
+        except BaseException:
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            raise
+        finally:
+            with self._lock:
+                entry.expires = time.monotonic() + ttl
+                entry.loading = None
+            event.set()
+        self._prune()
+        return entry.value
+
+    def invalidate(self, key: Hashable | None = None) -> None:
+        """
+        Remove a cached value, or all if no key is given
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def _prune(self) -> None:
+        """
+        Remove expired entries, so probes with changing arguments don't accumulate
+        """
+        now = time.monotonic()
+        if now - self._pruned < self.PRUNE_SECS:
+            return
+        with self._lock:
+            self._pruned = now
+            for key in [key for key, entry in self._entries.items() if entry.loading is None and now >= entry.expires]:
+                del self._entries[key]
+
+CACHE = SampleCache()
+
+def cached(ttl: float = 1.0, cache: SampleCache | None = None) -> Callable[[Callable[_P, _T]], Callable[_P, _T]]:
+    """
+    Cache the results of a function using its arguments as key, e.g.
+    ```
+    @cached(ttl=2)
+    def processes() -> list[dict[str, Any]]:
+        return [p.info for p in psutil.process_iter(['pid', 'name', 'cpu_percent'])]
+    ```
+    Arguments must be hashable
+
+    :param ttl: Time to live in seconds
+    :param cache: Cache to use, the shared CACHE by default
+    """
+    def decorator(fn: Callable[_P, _T]) -> Callable[_P, _T]:
+        name = f'{fn.__module__}.{fn.__qualname__}'
+
+        @functools.wraps(fn)
+        def wrapper(*args: _P.args, **kwargs: _P.kwargs) -> _T:
+            key = (name, args, tuple(sorted(kwargs.items())))
+            return (cache or CACHE).get(key, lambda: fn(*args, **kwargs), ttl)
+        return wrapper
+    return decorator
@@ -4,9 +4,11 @@ from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from enum import Enum
-from typing import Any, Generic, Self, TypeVar
+import sys
+import time
+from typing import Any, Generic, Self, Sequence, TypeVar
 
-from core.util import format_time
+from core.util import format_timestamp
 from core.config import ReadDict
 
 """
@@ -36,7 +38,7 @@ class Status(str, Enum):
     DEGRADED = 'Degraded'
     HEALTHY = 'Healthy'
 
-@dataclass
+@dataclass(slots=True)
 class Metric:
     name: str
     unit: str
@@ -45,6 +47,14 @@ class Metric:
     Note: must be serializable as JSON
     """
 
+    def __post_init__(self) -> None:
+        # Names and units repeat for every measurement, share a single copy.
+        # Existing packages also pass other types, e.g. None as unit
+        if type(self.name) is str:
+            self.name = sys.intern(self.name)
+        if type(self.unit) is str:
+            self.unit = sys.intern(self.unit)
+
     def toJSON(self) -> dict[str, Any]:
         return {
             'name': self.name,
@@ -53,20 +63,41 @@ class Metric:
         }
 
 class Measurement:
+    """
+    Result of a sensor measurement.
+    The time is stored as a unix timestamp and only converted when needed
+    """
+
+    __slots__ = ('timestamp', 'status', 'metrics', 'error', 'trace')
+
     @classmethod
     def now(cls, status: Status, metrics: list[Metric] = [], error: str | None = None, trace: list[str] | None = None) -> Self:
-        return cls(datetime.now(tz=timezone.utc), status, metrics, error, trace)
+        self = cls.__new__(cls)
+        self.timestamp = time.time()
+        self.status = status
+        self.metrics = metrics
+        self.error = error
+        self.trace = trace
+        return self
 
     def __init__(self, time: datetime, status: Status, metrics: list[Metric] = [], error: str | None = None, trace: list[str] | None = None) -> None:
-        self.time = time
+        self.timestamp = time.timestamp()
         self.status = status
         self.metrics = metrics
         self.error = error
         self.trace = trace
 
+    @property
+    def time(self) -> datetime:
+        return datetime.fromtimestamp(self.timestamp, tz=timezone.utc)
+
+    @time.setter
+    def time(self, value: datetime) -> None:
+        self.timestamp = value.timestamp()
+
     def toJSON(self) -> dict[str, Any]:
         return {
-            'time': format_time(self.time),
+            'time': format_timestamp(self.timestamp),
             'status': self.status.value,
             'metrics': [metric.toJSON() for metric in self.metrics],
             'error': {
@@ -129,6 +160,12 @@ class SensorBase(ABC, Generic[_Settings]):
         This is called once
         """
 
+    def stop(self) -> None:
+        """
+        Release resources.
+        This is called once when the sensor is removed from the settings while the collector is running
+        """
+
     @abstractmethod
     def measure(self) -> Measurement:
         """
@@ -137,6 +174,18 @@ class SensorBase(ABC, Generic[_Settings]):
         :returns: Sensor data
         """
 
+    @classmethod
+    def measure_group(cls, sensors: Sequence[Self]) -> list[Measurement]:
+        """
+        Perform a measurement for several sensors of this type at once.
+        Only used if the sensor is registered with `group=True`.
+        Override this to share expensive queries between sensors
+
+        :param sensors: Sensors that are due at the same time
+        :returns: Sensor data, one measurement per sensor in the same order
+        """
+        return [sensor.measure() for sensor in sensors]
+
 @dataclass
 class SensorDef:
    id: str
@@ -144,3 +193,5 @@ class SensorDef:
    settings: type[SettingsBase]
    batch: bool = True
    """Whether previous sensor data should be batched or ignored"""
+   group: bool = False
+   """Whether sensors with the same interval should be measured together using `measure_group()`"""
@@ -15,12 +15,24 @@ _default = object()
 
 ReadData = None | bool | int | float | str | list['ReadData'] | dict[str, 'ReadData']
 
+Path = str | tuple['Path', str | int]
+"""Location of a value, as a name or parent and key. Only formatted for error messages"""
+
+def format_path(path: Path) -> str:
+    parts = []
+    while not isinstance(path, str):
+        path, key = path
+        parts.append(f'[{key}]' if isinstance(key, int) else f'.{key}')
+    return path + ''.join(reversed(parts))
+
 class ReadValue:
     """
     Base value, can be casted using as_* methods
     """
 
-    def __init__(self, data: ReadData, path: str) -> None:
+    __slots__ = ('_data', '_path')
+
+    def __init__(self, data: ReadData, path: Path) -> None:
         self._data = data
         self._path = path
 
@@ -29,7 +41,7 @@ class ReadValue:
             return default
         if not isinstance(self._data, tys):
             names = [ty.__name__ for ty in tys]
-            raise TypeError(f'Expected {self._path} to be one of {names}, but got {type(self._data).__name__}')
+            raise TypeError(f'Expected {format_path(self._path)} to be one of {names}, but got {type(self._data).__name__}')
         return fn(self._data)
     
     def is_none(self) -> bool: return self._data is None
@@ -49,7 +61,7 @@ class ReadValue:
             return default
         if not isinstance(self._data, tys):
             names = [ty.__name__ for ty in tys]
-            raise TypeError(f'Expected {self._path} to be one of {names}')
+            raise TypeError(f'Expected {format_path(self._path)} to be one of {names}')
         return self._data
 
     @overload
@@ -95,9 +107,13 @@ class ReadList(Sequence[ReadValue]):
     List accessor
     """
 
-    def __init__(self, value: list[ReadData], path: str) -> None:
+    def __init__(self, value: list[ReadData], path: Path) -> None:
         self.value = value
-        self.path = path
+        self._path = path
+
+    @property
+    def path(self) -> str:
+        return format_path(self._path)
 
     @overload
     def __getitem__(self, index: int) -> ReadValue: ...
@@ -108,7 +124,7 @@ class ReadList(Sequence[ReadValue]):
         
         if isinstance(index, int):
             item = self.value[index] if index in range(-count, count) else None
-            return ReadValue(item, f'{self.path}[{index}]')
+            return ReadValue(item, (self._path, index))
         
         start = index.start if index.start is not None else 0
         stop = index.stop if index.stop is not None else -1
@@ -122,13 +138,13 @@ class ReadList(Sequence[ReadValue]):
         items = []
         for i in range(start, stop, step):
             item = self.value[i] if i in range(-count, count) else None
-            items.append(ReadValue(item, f'{self.path}[{index}]'))
+            items.append(ReadValue(item, (self._path, i)))
 
         return items
 
     def __iter__(self) -> Iterator[ReadValue]:
         for i, item in enumerate(self.value):
-            yield ReadValue(item, f'{self.path}[{i}]')
+            yield ReadValue(item, (self._path, i))
 
     def __len__(self) -> int:
         return len(self.value)
@@ -139,8 +155,9 @@ class ReadList(Sequence[ReadValue]):
         return value in self.value
     
     def __reversed__(self) -> Iterator[ReadValue]:
+        count = len(self.value)
         for i, item in enumerate(reversed(self.value)):
-            yield ReadValue(item, f'{self.path}[{i}]')
+            yield ReadValue(item, (self._path, count - 1 - i))
 
     def iter_bool(self) -> Iterator[bool]: return map(ReadValue.as_bool, self)
     def iter_int(self) -> Iterator[int]: return map(ReadValue.as_int, self)
@@ -154,12 +171,16 @@ class ReadDict(Mapping[str, ReadValue]):
     Dictionary accessor
     """
 
-    def __init__(self, value: dict[str, ReadData], path: str) -> None:
+    def __init__(self, value: dict[str, ReadData], path: Path) -> None:
         self.value = value
-        self.path = path
+        self._path = path
+
+    @property
+    def path(self) -> str:
+        return format_path(self._path)
 
     def __getitem__(self, key: str) -> ReadValue:
-        return ReadValue(self.value.get(key, None), f'{self.path}.{key}')
+        return ReadValue(self.value.get(key, None), (self._path, key))
     
     def __iter__(self) -> Iterator[str]:
         return iter(self.value)
@@ -0,0 +1,50 @@
+"""
+Suppression of measurements that did not change
+"""
+
+from __future__ import annotations
+
+from typing import Any
+
+from core.classes import Measurement
+
+class Deadband:
+    """
+    Filters measurements whose status, error and metrics are unchanged since the last emitted measurement.
+    Numeric metrics count as unchanged while they stay within the tolerance.
+    A measurement is always emitted once the refresh interval has passed
+    """
+
+    def __init__(self, tolerance: float, refresh_secs: float) -> None:
+        """
+        :param tolerance: Maximum absolute difference of numeric metrics that still counts as unchanged
+        :param refresh_secs: Maximum time between emitted measurements
+        """
+        self.tolerance = tolerance
+        self.refresh_secs = refresh_secs
+        self._last: Measurement | None = None
+
+    def _same(self, a: Any, b: Any) -> bool:
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)) and not isinstance(a, bool) and not isinstance(b, bool):
+            return abs(a - b) <= self.tolerance
+        return a == b
+
+    def changed(self, value: Measurement) -> bool:
+        """
+        Check whether a measurement should be emitted and remember it if so
+        """
+        last = self._last
+        if (
+            last is None
+            or value.timestamp - last.timestamp >= self.refresh_secs
+            or value.status != last.status
+            or value.error != last.error
+            or len(value.metrics) != len(last.metrics)
+            or any(
+                a.name != b.name or a.unit != b.unit or not self._same(a.value, b.value)
+                for a, b in zip(value.metrics, last.metrics)
+            )
+        ):
+            self._last = value
+            return True
+        return False
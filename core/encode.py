@@ -0,0 +1,101 @@
+"""
+Serialization of measurements for upload.
+Uses orjson if it is installed, otherwise the standard json module
+"""
+
+from __future__ import annotations
+
+import json
+import math
+from typing import Any
+
+from core.classes import Measurement, Metric
+from core.util import eprint, format_timestamp
+
+try:
+    import orjson # type: ignore
+except ImportError:
+    orjson = None
+
+def dumps(value: Any) -> bytes:
+    """
+    Serialize a value as compact JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':')).encode()
+
+def _check(value: Any) -> None:
+    """
+    Raise if a value can't be serialized as valid JSON
+    """
+    if orjson is not None:
+        orjson.dumps(value)
+    else:
+        # orjson writes NaN as null, the json module would write invalid JSON
+        json.dumps(value, allow_nan=False)
+
+def loads(data: bytes | str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# Metric values of these types are always serializable
+_SCALARS = (bool, int, float, str, type(None))
+
+class MeasurementEncoder:
+    """
+    Builds the upload payload for measurements of a single sensor.
+    The sensor-specific fields are computed once,
+    metrics are only checked for serializability the first time a new name/unit/type combination is seen
+    """
+
+    def __init__(self, sensor_id: str, message: str) -> None:
+        self.sensor_id = sensor_id
+        self.message = message
+        self._shapes = set[tuple[str, str, type]]()
+
+    def _metric(self, metric: Metric) -> dict[str, Any] | None:
+        data = metric.toJSON() if type(metric) is not Metric else {
+            'name': metric.name,
+            'unit': metric.unit,
+            'value': metric.value,
+        }
+
+        ty = type(metric.value)
+        if ty is float and not math.isfinite(metric.value):
+            # Not valid JSON, sent as null with either serializer
+            data['value'] = None
+        shape = (metric.name, metric.unit, ty)
+        if shape in self._shapes:
+            return data
+        try:
+            _check(data)
+        except Exception as e:
+            eprint(f'ERR: Serializing metric failed: {e}')
+            return None
+        # Lists and dicts might contain anything, check them every time
+        if ty in _SCALARS:
+            self._shapes.add(shape)
+        return data
+
+    def encode(self, value: Measurement) -> dict[str, Any]:
+        metrics = []
+        for metric in value.metrics:
+            # Ignore metrics with invalid JSON
+            data = self._metric(metric)
+            if data is not None:
+                metrics.append(data)
+
+        data = {
+            'time': format_timestamp(value.timestamp),
+            'sensorId': self.sensor_id,
+            'message': self.message,
+            'sensorHealthState': value.status,
+            'metrics': metrics,
+        }
+        if value.error is not None:
+            data['error'] = value.error
+        if value.trace is not None:
+            data['trace'] = value.trace
+        return data
@@ -0,0 +1,146 @@
+"""
+Internal metrics of the collector.
+Instruments are registered in REGISTRY and reported by the built-in `collector:metrics` sensor
+"""
+
+from __future__ import annotations
+
+from threading import Lock
+from typing import Callable
+
+from core.classes import Measurement, Metric, SensorBase, SensorDef, SettingsBase, Status
+
+Key = tuple[str, str | None]
+"""Metric name and optional label, e.g. the sensor name"""
+
+class Counter:
+    """
+    Monotonically increasing value
+    """
+
+    def __init__(self, name: str, unit: str, label: str | None) -> None:
+        self.name = name
+        self.unit = unit
+        self.label = label
+        self.value = 0
+        self._lock = Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+class Gauge:
+    """
+    Value that is read from a callback when the metrics are collected
+    """
+
+    def __init__(self, name: str, unit: str, label: str | None, fn: Callable[[], float]) -> None:
+        self.name = name
+        self.unit = unit
+        self.label = label
+        self.fn = fn
+
+    @property
+    def value(self) -> float:
+        return self.fn()
+
+class Histogram:
+    """
+    Distribution of observed values, counted into cumulative buckets
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name: str, unit: str, label: str | None, buckets: tuple[float, ...] = BUCKETS) -> None:
+        self.name = name
+        self.unit = unit
+        self.label = label
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        """Number of values per bucket, the last one counts values above all bounds"""
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float) -> None:
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+class Registry:
+    def __init__(self) -> None:
+        self.counters = dict[Key, Counter]()
+        self.gauges = dict[Key, Gauge]()
+        self.histograms = dict[Key, Histogram]()
+        self._lock = Lock()
+
+    def counter(self, name: str, unit: str = '', label: str | None = None) -> Counter:
+        with self._lock:
+            if (name, label) not in self.counters:
+                self.counters[name, label] = Counter(name, unit, label)
+            return self.counters[name, label]
+
+    def gauge(self, name: str, fn: Callable[[], float], unit: str = '', label: str | None = None) -> Gauge:
+        """
+        Register a gauge, replacing a previous one with the same name and label
+        """
+        with self._lock:
+            gauge = self.gauges[name, label] = Gauge(name, unit, label, fn)
+            return gauge
+
+    def histogram(self, name: str, unit: str = '', label: str | None = None) -> Histogram:
+        with self._lock:
+            if (name, label) not in self.histograms:
+                self.histograms[name, label] = Histogram(name, unit, label)
+            return self.histograms[name, label]
+
+    def remove(self, label: str) -> None:
+        """
+        Remove all metrics with the given label
+        """
+        with self._lock:
+            for metrics in (self.counters, self.gauges, self.histograms):
+                for key in [key for key in metrics if key[1] == label]:
+                    del metrics[key]
+
+REGISTRY = Registry()
+
+def _metric_name(name: str, label: str | None) -> str:
+    return name if label is None else f'{name}[{label}]'
+
+class CollectorSensor(SensorBase[SettingsBase]):
+    """
+    Reports the internal metrics of the collector.
+    Histograms are reported as total count and the mean of the values observed since the previous measurement
+    """
+
+    def __init__(self, settings: SettingsBase) -> None:
+        self.previous = dict[Key, tuple[int, float]]()
+
+    def measure(self) -> Measurement:
+        metrics = list[Metric]()
+        for counter in list(REGISTRY.counters.values()):
+            metrics.append(Metric(_metric_name(counter.name, counter.label), counter.unit, counter.value))
+        for gauge in list(REGISTRY.gauges.values()):
+            try:
+                value = gauge.value
+            except Exception:
+                continue
+            metrics.append(Metric(_metric_name(gauge.name, gauge.label), gauge.unit, value))
+        for key, histogram in list(REGISTRY.histograms.items()):
+            name = _metric_name(histogram.name, histogram.label)
+            count, total = histogram.count, histogram.sum
+            prev_count, prev_total = self.previous.get(key, (0, 0.0))
+            self.previous[key] = (count, total)
+            mean = (total - prev_total) / (count - prev_count) if count > prev_count else None
+            metrics.append(Metric(name + '.count', '', count))
+            metrics.append(Metric(name + '.mean', histogram.unit, mean))
+        return Measurement.now(Status.HEALTHY, metrics)
+
+SENSORS = [
+    SensorDef('metrics', CollectorSensor, SettingsBase),
+]
@@ -0,0 +1,196 @@
+"""
+Local scrape endpoint serving the latest sensor values and internal metrics in OpenMetrics text format
+"""
+
+from __future__ import annotations
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import math
+import re
+from threading import Lock, Thread
+from typing import Iterable, TypeVar
+
+from core.classes import Measurement
+from core.metrics import Counter, Gauge, Histogram, Registry
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+_INVALID = re.compile(r'[^a-zA-Z0-9_]')
+
+def _name(name: str) -> str:
+    name = _INVALID.sub('_', name)
+    return '_' + name if name[:1].isdigit() else name
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels: dict[str, str]) -> str:
+    return ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+def _number(value: object) -> str | None:
+    """
+    Format a metric value, None if it is not numeric
+    """
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return None
+
+_Instrument = TypeVar('_Instrument', Counter, Gauge, Histogram)
+
+def _by_name(instruments: Iterable[_Instrument]) -> list[_Instrument]:
+    """
+    Instruments sorted by name, so the samples of a metric family are contiguous
+    """
+    return sorted(instruments, key=lambda instrument: instrument.name)
+
+class _Sensor:
+    __slots__ = ('labels', 'value', 'rendered', 'lines')
+
+    def __init__(self, labels: str) -> None:
+        self.labels = labels
+        self.value: Measurement | None = None
+        self.rendered: Measurement | None = None
+        self.lines: tuple[str, str, str] = ('', '', '')
+        """Metric, status and timestamp samples rendered from `rendered`"""
+
+class Snapshot:
+    """
+    Latest measurement of every sensor.
+    Samples of a sensor are only rendered again after it reported a new measurement
+    """
+
+    def __init__(self, registry: Registry, prefix: str = 'insights') -> None:
+        self.registry = registry
+        self.prefix = prefix
+        self._sensors = dict[int, _Sensor]()
+        """Sensors by index, uuids are not always unique"""
+        self._lock = Lock()
+
+    def register(self, key: int, labels: dict[str, str]) -> None:
+        with self._lock:
+            self._sensors[key] = _Sensor(_labels(labels))
+
+    def unregister(self, key: int) -> None:
+        with self._lock:
+            self._sensors.pop(key, None)
+
+    def update(self, key: int, value: Measurement) -> None:
+        sensor = self._sensors.get(key)
+        if sensor is not None:
+            sensor.value = value
+
+    def _render_sensor(self, sensor: _Sensor, value: Measurement) -> tuple[str, str, str]:
+        metrics = []
+        for metric in value.metrics:
+            number = _number(metric.value)
+            if number is not None:
+                unit = str(metric.unit) if metric.unit is not None else ''
+                labels = f'{sensor.labels},metric="{_escape(str(metric.name))}",unit="{_escape(unit)}"'
+                metrics.append(f'{self.prefix}_sensor_value{{{labels}}} {number}\n')
+        status = f'{self.prefix}_sensor_status{{{sensor.labels},status="{_escape(value.status.value)}"}} 1\n'
+        timestamp = f'{self.prefix}_sensor_timestamp_seconds{{{sensor.labels}}} {value.timestamp!r}\n'
+        return ''.join(metrics), status, timestamp
+
+    def _render_registry(self) -> list[str]:
+        prefix = self.prefix + '_collector_'
+        out = []
+        families = set[str]()
+
+        def family(name: str, type: str):
+            # Instruments with different labels share a single metric family
+            if name not in families:
+                families.add(name)
+                out.append(f'# TYPE {name} {type}\n')
+
+        for counter in _by_name(self.registry.counters.values()):
+            name = prefix + _name(counter.name)
+            labels = f'{{sensor_id="{_escape(counter.label)}"}}' if counter.label is not None else ''
+            family(name, 'counter')
+            out.append(f'{name}_total{labels} {counter.value}\n')
+        for gauge in _by_name(self.registry.gauges.values()):
+            try:
+                number = _number(gauge.value)
+            except Exception:
+                continue
+            if number is None:
+                continue
+            name = prefix + _name(gauge.name)
+            labels = f'{{sensor_id="{_escape(gauge.label)}"}}' if gauge.label is not None else ''
+            family(name, 'gauge')
+            out.append(f'{name}{labels} {number}\n')
+        for histogram in _by_name(self.registry.histograms.values()):
+            name = prefix + _name(histogram.name)
+            label = f'sensor_id="{_escape(histogram.label)}",' if histogram.label is not None else ''
+            counts, total = list(histogram.counts), histogram.sum
+            family(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip((*histogram.buckets, math.inf), counts):
+                cumulative += count
+                out.append(f'{name}_bucket{{{label}le="{_number(float(bound))}"}} {cumulative}\n')
+            labels = f'{{{label[:-1]}}}' if label else ''
+            out.append(f'{name}_count{labels} {cumulative}\n{name}_sum{labels} {total!r}\n')
+        return out
+
+    def render(self) -> bytes:
+        with self._lock:
+            sensors = list(self._sensors.values())
+        metrics, statuses, timestamps = [], [], []
+        for sensor in sensors:
+            value = sensor.value
+            if value is not sensor.rendered and value is not None:
+                sensor.lines = self._render_sensor(sensor, value)
+                sensor.rendered = value
+            lines = sensor.lines
+            metrics.append(lines[0])
+            statuses.append(lines[1])
+            timestamps.append(lines[2])
+
+        prefix = self.prefix
+        out = [
+            f'# TYPE {prefix}_sensor_value gauge\n', *metrics,
+            f'# TYPE {prefix}_sensor_status gauge\n', *statuses,
+            f'# TYPE {prefix}_sensor_timestamp_seconds gauge\n', *timestamps,
+            *self._render_registry(),
+            '# EOF\n',
+        ]
+        return ''.join(out).encode()
+
+class MetricsServer:
+    """
+    HTTP server rendering a snapshot on every request
+    """
+
+    def __init__(self, snapshot: Snapshot, host: str, port: int) -> None:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = snapshot.render()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,229 @@
+"""
+Runs sensors in separate worker processes.
+Isolates the collector from sensors that hold the GIL, leak memory or crash the interpreter.
+
+Workers are started as `python -m core.process` and communicate over a local authenticated connection.
+Measurements are sent as plain tuples
+"""
+
+from __future__ import annotations
+
+import importlib
+from multiprocessing.connection import Client, Connection, Listener
+import os
+import secrets
+import subprocess
+import sys
+from threading import Lock
+import traceback
+from typing import Any
+
+from core.classes import Measurement, Metric, SensorBase, SensorDef, SettingsBase, Status
+from core.config import ReadData, ReadValue
+from core.util import eprint
+
+class RemoteSensor(SensorBase[SettingsBase]):
+    """
+    Proxy for a sensor running in a worker process
+    """
+
+    def __init__(self, worker: _Worker, key: int, type: str, data: ReadData, timeout: float | None) -> None:
+        self.worker = worker
+        self.key = key
+        self.type = type
+        self.data = data
+        self.timeout = timeout
+
+    def start(self) -> None:
+        self.worker.start(self)
+
+    def measure(self) -> Measurement:
+        timestamp, status, metrics, error = self.worker.call(('measure', self.key), self.timeout)
+        result = Measurement.now(Status(status), [Metric(*metric) for metric in metrics], error)
+        result.timestamp = timestamp
+        return result
+
+    def stop(self) -> None:
+        self.worker.stop(self)
+
+class _Worker:
+    """
+    A worker process, restarted automatically after it crashed or timed out
+    """
+
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.lock = Lock()
+        self.proc: subprocess.Popen[bytes] | None = None
+        self.conn: Connection | None = None
+        self.sensors = dict[int, RemoteSensor]()
+        """Started sensors, started again when the process is restarted"""
+        self.restarts = 0
+
+    def _spawn(self) -> Connection:
+        authkey = secrets.token_bytes(32)
+        self.proc = subprocess.Popen(
+            (sys.executable, '-m', 'core.process'),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        )
+        assert self.proc.stdin is not None and self.proc.stdout is not None
+        self.proc.stdin.write(authkey.hex().encode() + b'\n')
+        self.proc.stdin.close()
+        address = self.proc.stdout.readline().decode().split()
+        self.proc.stdout.close()
+        if len(address) != 2:
+            self.proc.wait()
+            raise RuntimeError(f'Sensor worker failed to start (exit code {self.proc.returncode})')
+
+        conn = Client((address[0], int(address[1])), authkey=authkey)
+        for sensor in self.sensors.values():
+            conn.send(('start', sensor.key, sensor.type, sensor.data))
+            reply = conn.recv()
+            if reply[0] != 'ok':
+                eprint(f'ERR: Sensor failed to restart: {reply[1]}')
+        return conn
+
+    def _kill(self) -> None:
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def _call(self, message: tuple[Any, ...], timeout: float | None) -> Any:
+        if self.conn is None:
+            if self.sensors:
+                self.restarts += 1
+                eprint(f'WARN: Restarting sensor worker {self.index}')
+            self.conn = self._spawn()
+        try:
+            self.conn.send(message)
+            if not self.conn.poll(timeout):
+                self._kill()
+                raise TimeoutError('Sensor worker did not respond, restarting it')
+            reply = self.conn.recv()
+        except (EOFError, OSError) as e:
+            self._kill()
+            raise RuntimeError(f'Sensor worker crashed: {e}')
+        if reply[0] != 'ok':
+            raise RuntimeError(reply[1])
+        return reply[1:]
+
+    def call(self, message: tuple[Any, ...], timeout: float | None = None) -> Any:
+        with self.lock:
+            return self._call(message, timeout)
+
+    def start(self, sensor: RemoteSensor) -> None:
+        with self.lock:
+            self._call(('start', sensor.key, sensor.type, sensor.data), None)
+            self.sensors[sensor.key] = sensor
+
+    def stop(self, sensor: RemoteSensor) -> None:
+        with self.lock:
+            if self.sensors.pop(sensor.key, None) is not None and self.conn is not None:
+                self._call(('stop', sensor.key), sensor.timeout)
+
+    def close(self) -> None:
+        if not self.lock.acquire(timeout=5):
+            # A sensor without timeout is hung, its call is abandoned
+            if self.proc is not None:
+                self.proc.kill()
+            return
+        try:
+            if self.conn is not None:
+                try:
+                    self.conn.send(('exit',))
+                except OSError:
+                    pass
+            if self.proc is not None:
+                try:
+                    self.proc.wait(5)
+                except subprocess.TimeoutExpired:
+                    pass
+            self._kill()
+        finally:
+            self.lock.release()
+
+class ProcessPool:
+    """
+    Pool of worker processes, sensors are distributed evenly across them
+    """
+
+    def __init__(self, workers: int) -> None:
+        self._workers = [_Worker(i) for i in range(workers)]
+        self._count = 0
+
+    def sensor(self, type: str, data: ReadData, timeout: float | None = None) -> RemoteSensor:
+        """
+        Create a sensor running in a worker process
+
+        :param type: Sensor type as `package:identifier`
+        :param data: Sensor settings from settings.json
+        :param timeout: Time after which an unresponsive worker is restarted
+        """
+        worker = self._workers[self._count % len(self._workers)]
+        self._count += 1
+        return RemoteSensor(worker, self._count, type, data, timeout)
+
+    def close(self) -> None:
+        for worker in self._workers:
+            worker.close()
+
+def _load(type: str, modules: dict[str, Any]) -> SensorDef:
+    pkg, id = type.split(':')
+    if pkg not in modules:
+        modules[pkg] = importlib.import_module(f'packages.{pkg}.sensors')
+    for sensor in modules[pkg].SENSORS:
+        if sensor.id == id:
+            return sensor
+    raise KeyError(f'Unknown sensor {type!r}')
+
+def _serve(conn: Connection) -> None:
+    modules = dict[str, Any]()
+    sensors = dict[int, SensorBase]()
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        try:
+            match message:
+                case ('start', key, type, data):
+                    definition = _load(type, modules)
+                    settings = definition.settings.deserialize(ReadValue(data, 'settings').as_dict())
+                    sensor = definition.sensor(settings)
+                    sensor.start()
+                    sensors[key] = sensor
+                    reply = ('ok',)
+                case ('measure', key):
+                    result = sensors[key].measure()
+                    metrics = [(metric.name, metric.unit, metric.value) for metric in result.metrics]
+                    reply = ('ok', result.timestamp, result.status.value, metrics, result.error)
+                case ('stop', key):
+                    sensor = sensors.pop(key, None)
+                    if sensor is not None:
+                        sensor.stop()
+                    reply = ('ok',)
+                case ('exit',):
+                    return
+                case _:
+                    reply = ('err', f'Unknown message {message[0]!r}')
+        except Exception as e:
+            traceback.print_exc()
+            reply = ('err', str(e))
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # e.g. metric values that can't be pickled
+            conn.send(('err', str(e)))
+
+if __name__ == '__main__':
+    authkey = bytes.fromhex(sys.stdin.readline().strip())
+    with Listener(('127.0.0.1', 0), authkey=authkey) as listener:
+        print(*listener.address, flush=True)
+        # stdout is read by the collector, sensor output goes to stderr instead
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        with listener.accept() as conn:
+            _serve(conn)
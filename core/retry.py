@@ -0,0 +1,128 @@
+"""
+Retry policy and circuit breaker for requests to unreliable endpoints
+"""
+
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+from threading import Lock
+import time
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter
+    """
+
+    def __init__(self, retries: int, base_secs: float, max_secs: float) -> None:
+        """
+        :param retries: Number of retries after the first attempt
+        :param base_secs: Delay before the first retry
+        :param max_secs: Upper bound for the delay between retries
+        """
+        self.retries = retries
+        self.base_secs = base_secs
+        self.max_secs = max_secs
+
+    def delay(self, attempt: int) -> float:
+        """
+        Get the delay before a retry
+
+        :param attempt: Number of failed attempts so far, starting at 1
+        """
+        return random.uniform(0, min(self.max_secs, self.base_secs * 2 ** (attempt - 1)))
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Parse a Retry-After header, given either as seconds or as an HTTP date
+
+    :returns: Delay in seconds or None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(tz=timezone.utc)).total_seconds(), 0)
+
+class CircuitBreaker:
+    """
+    Stops requests to an endpoint after repeated failures.
+    Once the reset time has passed a single probe request is let through,
+    which closes the circuit on success or opens it again on failure.
+    Other requests are held back while the probe is in flight
+    """
+
+    def __init__(self, threshold: int, reset_secs: float, max_reset_secs: float | None = None) -> None:
+        """
+        :param threshold: Number of consecutive failures until the circuit opens
+        :param reset_secs: Time until the first probe
+        :param max_reset_secs: Upper bound for the time between probes, which doubles after every failed probe
+        """
+        self.threshold = threshold
+        self.reset_secs = reset_secs
+        self.max_reset_secs = max_reset_secs if max_reset_secs is not None else reset_secs * 16
+        self.failures = 0
+        self.trips = 0
+        """Number of consecutive times the circuit was opened"""
+        self.open_until: float | None = None
+        self._lock = Lock()
+
+    def is_open(self) -> bool:
+        return self.open_until is not None and time.monotonic() < self.open_until
+
+    def allow(self) -> bool:
+        """
+        Whether a request may be sent now.
+        The caller must report the result with success() or failure()
+        """
+        with self._lock:
+            if self.open_until is None:
+                return True
+            now = time.monotonic()
+            if now < self.open_until:
+                return False
+            # Let this request probe and hold back the others.
+            # If the probe never reports a result, another one is let through after the reset time
+            self.open_until = now + self.reset_secs
+            return True
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.trips = 0
+            self.open_until = None
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            # A failed probe opens the circuit again right away
+            if self.open_until is not None or self.failures >= self.threshold:
+                self._trip(None)
+
+    def trip(self, secs: float | None = None) -> None:
+        """
+        Open the circuit
+
+        :param secs: Minimum time until the next probe, e.g. from a Retry-After header
+        """
+        with self._lock:
+            self._trip(secs)
+
+    def _trip(self, secs: float | None) -> None:
+        self.trips += 1
+        reset = min(self.max_reset_secs, self.reset_secs * 2 ** (self.trips - 1))
+        # Spread probes so a fleet of collectors does not reconnect at the same time
+        reset = random.uniform(reset / 2, reset)
+        if secs is not None:
+            reset = max(reset, secs)
+        self.failures = 0
+        self.open_until = time.monotonic() + reset
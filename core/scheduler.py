@@ -0,0 +1,165 @@
+"""
+Deadline based scheduler. Runs periodic jobs at a fixed rate on a bounded worker pool
+"""
+
+from __future__ import annotations
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+import heapq
+import itertools
+import random
+from threading import Condition
+import time
+from typing import Any, Callable
+
+class Job:
+    """
+    A periodic job, created by Scheduler.add()
+    """
+
+    def __init__(self, fn: Callable[[], Any], secs: float, skipped: Callable[[], Any] | None = None) -> None:
+        self.fn = fn
+        self.secs = secs
+        self.skipped = skipped
+        self.future: Future[Any] | None = None
+        self.cancelled = False
+
+    def busy(self) -> bool:
+        """
+        Whether the previous invocation is still running
+        """
+        return self.future is not None and not self.future.done()
+
+    def cancel(self) -> None:
+        """
+        Stop scheduling this job. A running invocation is not interrupted
+        """
+        self.cancelled = True
+
+@dataclass(order=True)
+class _Entry:
+    due: float
+    seq: int
+    job: Job = field(compare=False)
+
+class Scheduler:
+    """
+    Keeps a heap of next due times and dispatches jobs onto a thread pool.
+    Ticks are fixed-rate on the monotonic clock, so the time a job takes does not shift its schedule
+    """
+
+    def __init__(self, workers: int) -> None:
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='measure')
+        self._heap = list[_Entry]()
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._stopped = False
+        self._running = set[Future[Any]]()
+        """Functions submitted to the worker pool that have not finished yet"""
+
+    def submit(self, fn: Callable[[], Any]) -> Future[Any]:
+        """
+        Run a function once on the worker pool
+        """
+        future = self._pool.submit(fn)
+        with self._cond:
+            self._running.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future[Any]) -> None:
+        with self._cond:
+            self._running.discard(future)
+
+    def add(self, secs: float, fn: Callable[[], Any], delay: float | None = None, skipped: Callable[[], Any] | None = None) -> Job:
+        """
+        Run a function every `secs` seconds.
+
+        :param delay: Time until the first run. Defaults to a random offset within one interval,
+                      so jobs sharing an interval don't all run at the same time
+        :param skipped: Called for every tick that is skipped because the previous run has not finished.
+                        It is called on the scheduler thread and must return quickly
+
+        :returns: The scheduled job
+        """
+        if delay is None:
+            delay = random.uniform(0, secs)
+        job = Job(fn, secs, skipped)
+        self._push(time.monotonic() + delay, job)
+        return job
+
+    def call_later(self, delay: float, fn: Callable[[], Any]) -> Job:
+        """
+        Run a function once after `delay` seconds.
+        The function is called on the scheduler thread and must return quickly
+
+        :returns: The scheduled job, can be cancelled
+        """
+        job = Job(fn, 0)
+        self._push(time.monotonic() + delay, job)
+        return job
+
+    def _push(self, due: float, job: Job) -> None:
+        with self._cond:
+            heapq.heappush(self._heap, _Entry(due, next(self._seq), job))
+            self._cond.notify()
+
+    def _next(self) -> _Entry | None:
+        """
+        Wait for the next due job
+
+        :returns: The entry or None if the scheduler was stopped
+        """
+        with self._cond:
+            while not self._stopped:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                entry = self._heap[0]
+                wait = entry.due - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                return heapq.heappop(self._heap)
+            return None
+
+    def run(self) -> None:
+        """
+        Dispatch jobs until stop() is called
+        """
+        while (entry := self._next()) is not None:
+            job = entry.job
+            if job.cancelled:
+                continue
+            if job.secs <= 0:
+                job.fn()
+                continue
+
+            # Never run the same job twice at the same time
+            if not job.busy():
+                job.future = self.submit(job.fn)
+            elif job.skipped is not None:
+                job.skipped()
+
+            due = entry.due + job.secs
+            now = time.monotonic()
+            if due <= now:
+                # Fell behind, skip missed ticks but stay on the original grid
+                due += ((now - due) // job.secs + 1) * job.secs
+            self._push(due, job)
+
+    def stop(self, timeout: float | None = None) -> bool:
+        """
+        Stop dispatching jobs and shut down the worker pool.
+        Functions that are still running after `timeout` seconds are abandoned
+
+        :returns: Whether all running functions have finished
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            running = list(self._running)
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        _, pending = wait(running, timeout)
+        return not pending
@@ -0,0 +1,119 @@
+"""
+Validation against the JSON schemas in ./schemas.
+Supports the subset of draft-07 used there: type, enum, const, pattern, minimum, maximum,
+properties, required, items, oneOf and local `$ref`s
+"""
+
+from __future__ import annotations
+
+import json
+import re
+from typing import Any
+
+from core.config import Path, ReadData, format_path
+
+_TYPES: dict[str, tuple[type, ...]] = {
+    'null': (type(None),),
+    'boolean': (bool,),
+    'integer': (int,),
+    'number': (int, float),
+    'string': (str,),
+    'array': (list,),
+    'object': (dict,),
+}
+
+class SchemaError(ValueError):
+    """
+    A value does not match its schema
+    """
+
+    def __init__(self, name: str, errors: list[str]) -> None:
+        super().__init__(f'Invalid {name}:\n' + '\n'.join(f'  {error}' for error in errors))
+        self.errors = errors
+
+class Schema:
+    def __init__(self, schema: dict[str, Any]) -> None:
+        self.schema = schema
+        self._patterns = dict[str, re.Pattern[str]]()
+
+    @classmethod
+    def load(cls, path: str) -> Schema:
+        with open(path, 'rt') as f:
+            return cls(json.load(f))
+
+    def validate(self, value: ReadData, name: str = '$') -> None:
+        """
+        :raises SchemaError: With all errors found
+        """
+        errors = self.errors(value, name)
+        if errors:
+            raise SchemaError(name, errors)
+
+    def errors(self, value: ReadData, name: str = '$') -> list[str]:
+        errors = list[str]()
+        self._validate(value, self.schema, name, errors)
+        return errors
+
+    def _resolve(self, ref: str) -> dict[str, Any]:
+        if not ref.startswith('#/'):
+            raise ValueError(f'Unsupported $ref {ref!r}')
+        schema: Any = self.schema
+        for key in ref[2:].split('/'):
+            schema = schema[key]
+        return schema
+
+    def _validate(self, value: Any, schema: dict[str, Any], path: Path, errors: list[str]) -> None:
+        if '$ref' in schema:
+            self._validate(value, self._resolve(schema['$ref']), path, errors)
+
+        if 'type' in schema:
+            types = _TYPES[schema['type']]
+            # bool is a subclass of int, but not a number in JSON
+            if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+                errors.append(f'{format_path(path)}: expected {schema["type"]}, got {_json_type(value)}')
+                return
+
+        if 'const' in schema and value != schema['const']:
+            errors.append(f'{format_path(path)}: expected {schema["const"]!r}')
+        if 'enum' in schema and value not in schema['enum']:
+            errors.append(f'{format_path(path)}: expected one of {schema["enum"]}, got {value!r}')
+        if 'pattern' in schema and isinstance(value, str):
+            pattern = self._patterns.get(schema['pattern'])
+            if pattern is None:
+                pattern = self._patterns[schema['pattern']] = re.compile(schema['pattern'])
+            if pattern.search(value) is None:
+                errors.append(f'{format_path(path)}: invalid value {value!r}')
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            if 'minimum' in schema and value < schema['minimum']:
+                errors.append(f'{format_path(path)}: must be at least {schema["minimum"]}')
+            if 'maximum' in schema and value > schema['maximum']:
+                errors.append(f'{format_path(path)}: must be at most {schema["maximum"]}')
+
+        if isinstance(value, dict):
+            for key in schema.get('required', ()):
+                if key not in value:
+                    errors.append(f'{format_path(path)}: missing {key!r}')
+            for key, subschema in schema.get('properties', {}).items():
+                if key in value:
+                    self._validate(value[key], subschema, (path, key), errors)
+        if isinstance(value, list) and 'items' in schema:
+            for i, item in enumerate(value):
+                self._validate(item, schema['items'], (path, i), errors)
+
+        if 'oneOf' in schema:
+            results = list[list[str]]()
+            for subschema in schema['oneOf']:
+                results.append([])
+                self._validate(value, subschema, path, results[-1])
+            matches = sum(1 for result in results if not result)
+            if matches == 0:
+                # Report the errors of the closest alternative
+                errors.extend(min(results, key=len))
+            elif matches > 1:
+                errors.append(f'{format_path(path)}: matches more than one alternative')
+
+def _json_type(value: Any) -> str:
+    for name, types in _TYPES.items():
+        if isinstance(value, types) and name != 'integer':
+            return name
+    return type(value).__name__
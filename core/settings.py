@@ -0,0 +1,259 @@
+"""
+Typed settings.
+settings.json and package manifests are validated once against the schemas in ./schemas
+and converted to immutable objects, all errors are reported at once
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+import json
+import os
+import platform
+from typing import Any
+from uuid import UUID
+
+from core.aggregate import FUNCTIONS as AGGREGATE_FUNCTIONS
+from core.config import ReadDict
+from core.schema import Schema, SchemaError
+from core.util import parse_interval
+
+DIR_SCHEMAS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'schemas')
+
+# Shortest supported sensor interval
+MIN_INTERVAL = 0.05
+
+@dataclass(frozen=True, slots=True)
+class HostConfig:
+    uuid: UUID
+    name: str
+    url: str
+    token: str
+    min_secs: float
+    max_secs: float
+    max_backlog: int
+    batch_size: int
+    """Maximum number of measurements per upload request, 0 disables batching"""
+    pool_size: int
+    keep_alive: bool
+    connect_timeout: float
+    read_timeout: float
+    spool_max_bytes: int
+    """Maximum size of the on-disk spool, 0 disables spooling"""
+    spool_max_secs: float
+    spool_replay: int
+    """Maximum number of spooled measurements replayed per upload cycle"""
+    retries: int
+    retry_secs: float
+    retry_max_secs: float
+    breaker_threshold: int
+    """Number of consecutive failed requests until uploads are paused"""
+    breaker_reset_secs: float
+    compression: str
+    """Request body compression, 'none', 'gzip' or 'zstd'"""
+    compression_threshold: int
+    """Minimum body size in bytes for compression"""
+    engine: str
+    """Upload engine, 'sync' or 'async'"""
+    concurrency: int
+    """Maximum number of concurrent requests of the async engine"""
+    machine_data_refresh_secs: float
+    """Time after which unchanged machine data is sent again"""
+    shutdown_secs: float
+    """Time available for uploading the remaining measurements when stopping"""
+
+@dataclass(frozen=True, slots=True)
+class SensorConfig:
+    uuid: UUID
+    type: str
+    name: str
+    data: ReadDict
+    """Sensor-specific settings, passed to SettingsBase.deserialize()"""
+    secs: float
+    timeout: float | None
+    quarantine_after: int
+    """Number of consecutive timeouts until a sensor is quarantined, 0 disables quarantine"""
+    quarantine_secs: float
+    aggregate_secs: float | None
+    """Aggregation window, None to upload every measurement"""
+    aggregate_functions: tuple[str, ...]
+    deadband: float | None
+    """Tolerance for unchanged metrics, None to upload every measurement"""
+    process: bool
+    """Whether the sensor runs in a worker process"""
+    batch: bool = True
+    """Whether previous measurements are kept or replaced, see SensorDef.batch"""
+    group: bool = False
+    """Whether the sensor is measured together with others of its type, see SensorDef.group"""
+
+    @property
+    def package(self) -> str:
+        return self.type.split(':')[0]
+
+@dataclass(frozen=True, slots=True)
+class PackageSource:
+    type: str
+    """'folder' or 'github'"""
+    path: str | None
+    """Directory of a folder package"""
+    pkg: str | None
+    repo: str | None
+    """GitHub repository as `owner/repo`"""
+    version: str
+    latest_ttl_secs: float
+    """Time the latest version of a GitHub package is cached"""
+
+@dataclass(frozen=True, slots=True)
+class Settings:
+    host: HostConfig
+    sensors: tuple[SensorConfig, ...]
+    packages: tuple[PackageSource, ...]
+    workers: int
+    metrics_server: tuple[str, int] | None
+    """Address of the OpenMetrics endpoint, None if disabled"""
+    process_workers: int
+    process_packages: frozenset[str]
+    reload_secs: float | None
+    """Interval in which the settings file is checked for changes, None to only reload on SIGHUP"""
+
+@dataclass(frozen=True, slots=True)
+class Manifest:
+    pkg: str
+    version: str
+    name: str
+    description: str
+    dependencies: tuple[str, ...]
+
+_schemas = dict[str, Schema]()
+
+def _load(path: str, schema: str, name: str) -> dict[str, Any]:
+    """
+    Load a JSON file and validate it, so values can be used as their schema describes
+    """
+    with open(path, 'rt') as f:
+        data = json.load(f)
+    if schema not in _schemas:
+        _schemas[schema] = Schema.load(os.path.join(DIR_SCHEMAS, schema))
+    _schemas[schema].validate(data, name)
+    return data
+
+def _interval(value: str | None) -> float | None:
+    return parse_interval(value) if value is not None else None
+
+def load_settings(path: str) -> Settings:
+    """
+    Load and validate settings.json
+
+    :raises SchemaError: If the settings are invalid
+    """
+    data = _load(path, 'settings.schema.json', 'settings')
+
+    upload = data['upload']
+    max_secs = parse_interval(upload['max_interval'])
+    host = HostConfig(
+        uuid=UUID(data['uuid']),
+        name=data.get('name', platform.node()),
+        url=data['url'],
+        token=data['token'],
+        min_secs=parse_interval(upload['min_interval']),
+        max_secs=max_secs,
+        max_backlog=int(upload['max_backlog']),
+        batch_size=upload.get('batch_size', 0),
+        pool_size=upload.get('pool_size', 4),
+        keep_alive=upload.get('keep_alive', True),
+        connect_timeout=parse_interval(upload.get('connect_timeout', '5s')),
+        read_timeout=parse_interval(upload.get('read_timeout', '30s')),
+        spool_max_bytes=upload.get('spool_max_bytes', 64 * 1024 * 1024),
+        spool_max_secs=parse_interval(upload.get('spool_max_age', '24h')),
+        spool_replay=upload.get('spool_replay', 1000),
+        retries=upload.get('retries', 3),
+        retry_secs=parse_interval(upload.get('retry_delay', '1s')),
+        retry_max_secs=parse_interval(upload.get('retry_max_delay', '30s')),
+        breaker_threshold=upload.get('breaker_threshold', 5),
+        breaker_reset_secs=parse_interval(upload.get('breaker_reset', '1m')),
+        compression=upload.get('compression', 'none'),
+        compression_threshold=upload.get('compression_threshold', 1024),
+        engine=upload.get('engine', 'sync'),
+        concurrency=upload.get('concurrency', 4),
+        machine_data_refresh_secs=_interval(upload.get('machine_data_refresh')) or max_secs,
+        shutdown_secs=parse_interval(upload.get('shutdown_timeout', '10s')),
+    )
+    errors = list[str]()
+    for key, value in (('connect_timeout', host.connect_timeout), ('read_timeout', host.read_timeout)):
+        if value <= 0:
+            errors.append(f'settings.upload.{key}: must be greater than 0')
+
+    process_packages = frozenset(data.get('process_packages', ()))
+    sensors = list[SensorConfig]()
+    for i, sensor in enumerate(data['sensors']):
+        type = sensor['type']
+        if type.count(':') != 1:
+            errors.append(f'settings.sensors[{i}].type: expected package:identifier, got {type!r}')
+            continue
+        secs = parse_interval(sensor['interval'])
+        if secs < MIN_INTERVAL:
+            errors.append(f'settings.sensors[{i}].interval: must be at least {int(MIN_INTERVAL * 1000)}ms')
+        timeout = _interval(sensor.get('timeout'))
+        aggregate_secs = _interval(sensor.get('aggregate'))
+        for key, value in (('timeout', timeout), ('aggregate', aggregate_secs)):
+            if value is not None and value <= 0:
+                errors.append(f'settings.sensors[{i}].{key}: must be greater than 0')
+        sensors.append(SensorConfig(
+            uuid=UUID(sensor['uuid']),
+            type=type,
+            name=sensor['name'],
+            data=ReadDict(sensor['settings'], ((('settings', 'sensors'), i), 'settings')),
+            secs=secs,
+            timeout=timeout,
+            quarantine_after=sensor.get('quarantine_after', 0),
+            quarantine_secs=parse_interval(sensor.get('quarantine', '10m')),
+            aggregate_secs=aggregate_secs,
+            aggregate_functions=tuple(sensor.get('aggregate_functions', AGGREGATE_FUNCTIONS)),
+            deadband=sensor.get('deadband'),
+            process=sensor.get('process', type.split(':')[0] in process_packages),
+        ))
+    if errors:
+        raise SchemaError('settings', errors)
+
+    packages = tuple(
+        PackageSource(
+            type=package['type'],
+            path=package.get('path'),
+            pkg=package.get('pkg'),
+            repo=package.get('repo'),
+            version=package.get('version', 'latest'),
+            latest_ttl_secs=parse_interval(package.get('latest_ttl', '1h')),
+        )
+        for package in data.get('packages', ())
+    )
+
+    metrics_server = None
+    if 'metrics_server' in data:
+        server = data['metrics_server']
+        metrics_server = (server.get('host', '127.0.0.1'), server.get('port', 9464))
+
+    return Settings(
+        host=host,
+        sensors=tuple(sensors),
+        packages=packages,
+        workers=data.get('workers', 8),
+        metrics_server=metrics_server,
+        process_workers=data.get('process_workers', 2),
+        process_packages=process_packages,
+        reload_secs=_interval(data.get('reload_interval')),
+    )
+
+def load_manifest(path: str) -> Manifest:
+    """
+    Load and validate the manifest.json of a sensor package
+
+    :raises SchemaError: If the manifest is invalid
+    """
+    data = _load(path, 'manifest.schema.json', 'manifest')
+    return Manifest(
+        pkg=data['pkg'],
+        version=data['version'],
+        name=data['name'],
+        description=data['description'],
+        dependencies=tuple(data['dependencies']),
+    )
@@ -0,0 +1,214 @@
+"""
+Durable on-disk queue for measurements that could not be uploaded.
+Values are appended as JSON lines to segment files and read back in order
+"""
+
+from __future__ import annotations
+
+import os
+import time
+from typing import IO, Any, Iterable
+
+from core.encode import dumps, loads
+from core.util import eprint
+
+_SUFFIX = '.jsonl'
+_CURSOR = 'cursor'
+
+Cursor = tuple[int, int]
+"""Read position as (segment, byte offset)"""
+
+class Spool:
+    """
+    Append-only queue of JSON values, split into segment files.
+    The oldest segments are deleted once they are read or when the spool exceeds its size or age limits
+    """
+
+    def __init__(self, path: str, max_bytes: int, max_age: float, segment_bytes: int = 1 << 20) -> None:
+        """
+        :param path: Directory for the segment files
+        :param max_bytes: Maximum size of all segments, the oldest segments are dropped beyond that
+        :param max_age: Maximum age of values in seconds, older values are dropped
+        :param segment_bytes: Size after which a new segment is started
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_bytes = min(segment_bytes, max(max_bytes // 4, 1))
+
+        os.makedirs(path, exist_ok=True)
+        names = (name[:-len(_SUFFIX)] for name in os.listdir(path) if name.endswith(_SUFFIX))
+        self._segments = sorted(int(name) for name in names if name.isdigit())
+        self._sizes = {seq: os.path.getsize(self._segment_path(seq)) for seq in self._segments}
+        self._cursor = self._load_cursor()
+        self._repair()
+
+    def _segment_path(self, seq: int) -> str:
+        return os.path.join(self.path, f'{seq:016d}{_SUFFIX}')
+
+    def _load_cursor(self) -> Cursor:
+        try:
+            with open(os.path.join(self.path, _CURSOR), 'rt') as f:
+                seq, offset = f.read().split()
+            cursor = int(seq), int(offset)
+        except (OSError, ValueError):
+            cursor = 0, 0
+        if cursor[0] not in self._sizes:
+            cursor = (self._segments[0] if self._segments else 0), 0
+        return cursor
+
+    def _save_cursor(self) -> None:
+        path = os.path.join(self.path, _CURSOR)
+        with open(path + '.tmp', 'wt') as f:
+            f.write(f'{self._cursor[0]} {self._cursor[1]}')
+        os.replace(path + '.tmp', path)
+
+    def _repair(self) -> None:
+        """
+        Cut off a partially written value at the end of the last segment
+        """
+        if not self._segments:
+            return
+        seq = self._segments[-1]
+        with open(self._segment_path(seq), 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end != len(data):
+                f.truncate(end)
+                self._sizes[seq] = end
+
+    def unread(self) -> int:
+        """
+        Number of unread bytes
+        """
+        seq, offset = self._cursor
+        return sum(size for s, size in self._sizes.items() if s >= seq) - offset
+
+    def size(self) -> int:
+        """
+        Total size of all segments in bytes
+        """
+        return sum(self._sizes.values())
+
+    def append(self, values: Iterable[Any]) -> None:
+        """
+        Write values to the end of the spool
+        """
+        now = time.time()
+        lines = (
+            dumps({'t': now, 'd': value}) + b'\n'
+            for value in values
+        )
+
+        f = None
+        try:
+            for line in lines:
+                if not self._segments or self._sizes[self._segments[-1]] >= self.segment_bytes:
+                    if f is not None:
+                        self._close(f)
+                        f = None
+                    seq = self._segments[-1] + 1 if self._segments else self._cursor[0]
+                    self._segments.append(seq)
+                    self._sizes[seq] = 0
+                seq = self._segments[-1]
+                if f is None:
+                    f = open(self._segment_path(seq), 'ab')
+                f.write(line)
+                self._sizes[seq] += len(line)
+        finally:
+            if f is not None:
+                self._close(f)
+
+        self.compact()
+
+    def _close(self, f: IO[bytes]) -> None:
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+    def read(self, limit: int) -> tuple[list[Any], Cursor]:
+        """
+        Read up to `limit` values, starting at the oldest unread one.
+        Values exceeding the maximum age are skipped and committed right away
+
+        :returns: Values and the cursor to pass to commit() once they have been processed
+        """
+        values = []
+        first: Cursor | None = None
+        """Position of the first value returned"""
+        expired = time.time() - self.max_age
+        seq, offset = self._cursor
+        for seq in self._segments[self._segments.index(seq):] if seq in self._sizes else []:
+            if seq != self._cursor[0]:
+                offset = 0
+            with open(self._segment_path(seq), 'rb') as f:
+                f.seek(offset)
+                while len(values) < limit and offset < self._sizes[seq]:
+                    start = offset
+                    line = f.readline()
+                    offset += len(line)
+                    try:
+                        item = loads(line)
+                        valid = item['t'] >= expired
+                        value = item['d']
+                    except (ValueError, KeyError, TypeError):
+                        eprint('WARN: Skipping corrupted spool entry')
+                        continue
+                    if valid:
+                        if first is None:
+                            first = seq, start
+                        values.append(value)
+            if len(values) >= limit:
+                break
+
+        # Don't read skipped values again if the returned ones are not committed
+        skipped = first if first is not None else (seq, offset)
+        if skipped != self._cursor:
+            self.commit(skipped)
+        return values, (seq, offset)
+
+    def commit(self, cursor: Cursor) -> None:
+        """
+        Mark values up to the cursor as processed and delete segments that have been read completely
+        """
+        self._cursor = cursor
+        seq, offset = cursor
+        # Start a new segment instead of appending behind the cursor forever
+        if self._segments and seq == self._segments[-1] and offset >= self._sizes[seq]:
+            self._drop_until(seq + 1)
+            self._cursor = seq + 1, 0
+        else:
+            self._drop_until(seq)
+        self._save_cursor()
+
+    def compact(self) -> None:
+        """
+        Delete segments that are too old or exceed the size limit
+        """
+        expired = time.time() - self.max_age
+        keep = 0
+        for i, seq in enumerate(self._segments):
+            if os.path.getmtime(self._segment_path(seq)) < expired:
+                keep = i + 1
+        total = self.size() - sum(self._sizes[seq] for seq in self._segments[:keep])
+        while total > self.max_bytes and keep < len(self._segments) - 1:
+            total -= self._sizes[self._segments[keep]]
+            keep += 1
+
+        if keep > 0:
+            dropped = self._segments[keep - 1]
+            if self._cursor[0] <= dropped:
+                eprint(f'WARN: Spool limit reached, dropping {keep} segment(s)')
+            self._drop_until(dropped + 1)
+
+    def _drop_until(self, seq: int) -> None:
+        """
+        Delete all segments before `seq`
+        """
+        while self._segments and self._segments[0] < seq:
+            first = self._segments.pop(0)
+            del self._sizes[first]
+            os.remove(self._segment_path(first))
+        if self._cursor[0] < seq:
+            self._cursor = (self._segments[0] if self._segments else seq), 0
+            self._save_cursor()
@@ -1,6 +1,7 @@
 from datetime import datetime
 from socket import AF_INET, AF_INET6, SOCK_DGRAM, socket
 import sys
+import time
 from types import EllipsisType
 from typing import Any, TypeVar
 
@@ -28,6 +29,16 @@ def parse_interval(interval: str) -> float:
 def format_time(time: datetime) -> str:
     return time.isoformat().replace('+00:00', 'Z')
 
+def format_timestamp(timestamp: float) -> str:
+    """
+    Format a unix timestamp like format_time(), without creating a datetime
+    """
+    seconds = int(timestamp // 1)
+    micros = round((timestamp - seconds) * 1_000_000)
+    if micros >= 1_000_000:
+        seconds, micros = seconds + 1, micros - 1_000_000
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)) + f'.{micros:06d}Z'
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
@@ -1,15 +1,26 @@
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import os
 import platform
 import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+from threading import Lock
+import time
+from typing import Any
 import urllib.parse
 import venv
 import requests
+from requests.adapters import HTTPAdapter
 import urllib
 import zipfile
 
-from core.config import ReadDict, ReadValue, parse_file
+from core.config import ReadValue
+from core.settings import Manifest, PackageSource, load_manifest, load_settings
 
 # Dependencies required for uploading results
 DEFAULT_DEPS = ['requests>=2', 'psutil']
@@ -17,8 +28,24 @@ DEFAULT_DEPS = ['requests>=2', 'psutil']
 DIR_RUN = './run'
 DIR_VENV = './run/venv'
 DIR_CORE = './run/core'
-DIR_TEMP = './run/temp'
 DIR_PACKAGES = './run/packages'
+# Fingerprint of the installed dependencies, removed together with the venv
+DEPS_LOCK = './run/venv/dependencies.lock'
+# Kept when the run directory is cleaned
+DIR_CACHE = './cache'
+
+# Number of packages installed at the same time
+PARALLEL_INSTALLS = 8
+CHUNK_SIZE = 1024 * 1024
+# Versions of a package kept in the download cache
+CACHE_VERSIONS = 3
+
+# Shared by all downloads, so connections to GitHub are reused
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=PARALLEL_INSTALLS * 2))
+
+# Sensor packages shipped with the collector, see BUILTIN_PACKAGES in main.py
+BUILTIN_PACKAGES = ['collector']
 
 def mkdir_clean(dir: str):
     if os.path.isdir(dir):
@@ -31,13 +58,205 @@ def mkdir_clean(dir: str):
     else:
         os.mkdir(dir)
 
-def _install_folder(package: ReadDict) -> ReadDict:
-    path = package['path'].as_str()
+def _file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def sync_file(src: str, dst: str) -> bool:
+    """
+    Copy a file if the destination differs.
+    Unchanged files keep their modification time, so their bytecode stays valid
+
+    :returns: Whether the file was copied
+    """
+    if os.path.isfile(dst):
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+        if src_stat.st_size == dst_stat.st_size:
+            if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+                return False
+            if _file_hash(src) == _file_hash(dst):
+                # Compare by modification time next time
+                shutil.copystat(src, dst)
+                return False
+    shutil.copy2(src, dst)
+    return True
+
+def sync_tree(src: str, dst: str) -> int:
+    """
+    Make a directory a copy of another, only copying changed files
+    and removing files that don't exist in the source. Bytecode caches are ignored
+
+    :returns: Number of copied and removed files
+    """
+    changes = 0
+    os.makedirs(dst, exist_ok=True)
+    names = set(os.listdir(src)) - {'__pycache__'}
+    for name in os.listdir(dst):
+        path = os.path.join(dst, name)
+        if name == '__pycache__':
+            continue
+        if name not in names or os.path.isdir(path) != os.path.isdir(os.path.join(src, name)):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            changes += 1
+
+    for name in names:
+        src_path, dst_path = os.path.join(src, name), os.path.join(dst, name)
+        if os.path.isdir(src_path):
+            changes += sync_tree(src_path, dst_path)
+        elif sync_file(src_path, dst_path):
+            changes += 1
+    return changes
+
+class DownloadCache:
+    """
+    Content-addressed cache of downloaded package files.
+    Files are stored by their SHA-256 hash and looked up by repository and version,
+    the latest version of a repository is remembered with its ETag
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.objects = os.path.join(path, 'objects')
+        self.index_path = os.path.join(path, 'index.json')
+        self.lock = Lock()
+        os.makedirs(self.objects, exist_ok=True)
+        try:
+            with open(self.index_path, 'rt') as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {'releases': {}, 'latest': {}}
+
+    def object(self, hash: str) -> str:
+        return os.path.join(self.objects, hash)
+
+    def fetch(self, url: str) -> str:
+        """
+        Download a file into the cache
+
+        :returns: SHA-256 hash of the file
+        """
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile('wb', dir=self.objects, delete=False) as f:
+            try:
+                with session.get(url, stream=True) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        digest.update(chunk)
+                        f.write(chunk)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        hash = digest.hexdigest()
+        os.replace(f.name, self.object(hash))
+        return hash
+
+    def verify(self, hash: str) -> bool:
+        """
+        Check that a cached file exists and was not modified
+        """
+        try:
+            return _file_hash(self.object(hash)) == hash
+        except OSError:
+            return False
+
+    def release(self, repo: str, version: str) -> dict[str, str] | None:
+        """
+        :returns: Hashes of the cached files of a release, None if it is not cached or damaged
+        """
+        with self.lock:
+            release = self.index['releases'].get(repo, {}).get(version)
+        if release is None:
+            return None
+        if not all(self.verify(hash) for hash in release['files'].values()):
+            print(f'  Cached files of {repo} {version} are damaged')
+            return None
+        with self.lock:
+            release['used'] = time.time()
+        return release['files']
+
+    def add_release(self, repo: str, version: str, files: dict[str, str]):
+        with self.lock:
+            self.index['releases'].setdefault(repo, {})[version] = {'files': files, 'used': time.time()}
+
+    def latest(self, repo: str) -> dict[str, Any] | None:
+        """
+        :returns: Latest version, ETag and time of the last check
+        """
+        with self.lock:
+            return self.index['latest'].get(repo)
+
+    def set_latest(self, repo: str, version: str, etag: str | None):
+        with self.lock:
+            self.index['latest'][repo] = {'version': version, 'etag': etag, 'checked': time.time()}
+
+    def save(self):
+        """
+        Write the index and remove files of old versions
+        """
+        with self.lock:
+            for releases in self.index['releases'].values():
+                for version in sorted(releases, key=lambda version: releases[version]['used'])[:-CACHE_VERSIONS]:
+                    del releases[version]
+            used = {hash for releases in self.index['releases'].values() for release in releases.values() for hash in release['files'].values()}
+            for name in os.listdir(self.objects):
+                if name not in used:
+                    os.remove(self.object(name))
+
+            tmp = self.index_path + '.tmp'
+            with open(tmp, 'wt') as f:
+                json.dump(self.index, f, indent='  ')
+            os.replace(tmp, self.index_path)
+
+def _latest_version(id: str, repo: str, url: str, ttl: float) -> str:
+    """
+    Find the latest version of a package.
+    Uses the cached version for `ttl` seconds or if GitHub can't be reached,
+    and a conditional request otherwise, so unchanged releases don't count against the rate limit
+    """
+    cached = cache.latest(repo)
+    if cached is not None and time.time() - cached['checked'] < ttl:
+        print(f'  {id}: Latest version is {cached["version"]} (cached)')
+        return cached['version']
+
+    headers = {'If-None-Match': cached['etag']} if cached is not None and cached['etag'] else {}
+    print(f'  {id}: Finding latest version on GitHub')
+    try:
+        response = session.get(url, headers=headers, timeout=30)
+        if response.status_code == 304 and cached is not None:
+            version = cached['version']
+        else:
+            response.raise_for_status()
+            value = ReadValue(response.json(), 'response').as_dict()
+            tag_name = value['tag_name'].as_str()
+            if not tag_name.startswith('v'):
+                raise ValueError('Invalid tag name')
+            version = tag_name[1:]
+    except requests.RequestException as e:
+        if cached is None:
+            raise
+        print(f'  {id}: GitHub unavailable ({e}), using cached version')
+        return cached['version']
+
+    etag = response.headers.get('ETag', headers.get('If-None-Match'))
+    cache.set_latest(repo, version, etag)
+    print(f'  {id}: Latest version is {version}')
+    return version
+
+def _install_folder(package: PackageSource) -> Manifest:
+    assert package.path is not None
+    path = package.path
     config_path = os.path.join(path, 'manifest.json')
     sensors_path = os.path.join(path, 'sensors')
 
-    config = parse_file(config_path, 'manifest').as_dict()
-    id = config['pkg'].as_str()
+    config = load_manifest(config_path)
+    id = config.pkg
 
     print(f'Installing package {id!r} from {path}')
 
@@ -45,38 +264,36 @@ def _install_folder(package: ReadDict) -> ReadDict:
     config_dst_path = os.path.join(dst_path, 'manifest.json')
     sensors_dst_path = os.path.join(dst_path, 'sensors')
 
-    mkdir_clean(dst_path)
+    os.makedirs(dst_path, exist_ok=True)
+    for name in os.listdir(dst_path):
+        if name not in ('manifest.json', 'sensors'):
+            path = os.path.join(dst_path, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
 
-    shutil.copyfile(config_path, config_dst_path)
-    shutil.copytree(sensors_path, sensors_dst_path)
+    changes = sync_file(config_path, config_dst_path) + sync_tree(sensors_path, sensors_dst_path)
+    if not changes:
+        print(f'  {id}: Already up to date')
 
     return config
 
-def _install_github(package: ReadDict) -> ReadDict:
-    id = package['pkg'].as_str()
-    repo_id = package['repo'].as_str()
+def _install_github(package: PackageSource) -> Manifest:
+    assert package.pkg is not None and package.repo is not None
+    id = package.pkg
+    repo_id = package.repo
     owner, repo = repo_id.split('/', 1)
-    version = package['version'].as_str('latest')
+    version = package.version
 
     owner_safe = urllib.parse.quote(owner)
     repo_safe = urllib.parse.quote(repo)
 
-    session = requests.Session()
-
     print(f'Installing package {id!r} from GitHub')
 
     if version == 'latest':
-        print(f'  Finding latest version on GitHub')
-
-        response = session.get(f'https://api.github.com/repos/{owner_safe}/{repo_safe}/releases/latest')
-        response.raise_for_status()
-        value = ReadValue(response.json(), 'response').as_dict()
-        tag_name = value['tag_name'].as_str()
-        if not tag_name.startswith('v'):
-            raise ValueError('Invalid tag name')
-        version = tag_name[1:]
-
-        print(f'  Latest version is {version}')
+        url = f'https://api.github.com/repos/{owner_safe}/{repo_safe}/releases/latest'
+        version = _latest_version(id, repo_id, url, package.latest_ttl_secs)
 
     dst_path = os.path.join(DIR_PACKAGES, id)
     config_dst_path = os.path.join(dst_path, 'manifest.json')
@@ -84,62 +301,62 @@ def _install_github(package: ReadDict) -> ReadDict:
 
     old_version = None
     if os.path.exists(config_dst_path):
-        config = parse_file(config_dst_path, 'manifest').as_dict()
-        old_version = config['version'].as_str()
+        try:
+            config = load_manifest(config_dst_path)
+            old_version = config.version
+        except ValueError as e:
+            # Install again
+            print(f'  {id}: {e}')
 
     if version != old_version:
-        print(f'  Downloading {version}')
-
-        version_safe = urllib.parse.quote(version)
-        download_url = f'https://github.com/{owner_safe}/{repo_safe}/releases/download/v{version_safe}'
+        files = cache.release(repo_id, version)
+        if files is None:
+            print(f'  {id}: Downloading {version}')
+            version_safe = urllib.parse.quote(version)
+            download_url = f'https://github.com/{owner_safe}/{repo_safe}/releases/download/v{version_safe}'
+
+            # Download the sensors while the manifest is checked
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                sensors = executor.submit(cache.fetch, download_url + '/sensors.zip')
+
+                manifest = cache.fetch(download_url + '/manifest.json')
+                config = load_manifest(cache.object(manifest))
+                new_id, new_version = config.pkg, config.version
+                if new_id != id:
+                    raise ValueError(f'  Package id mismatch: expected {id}, got {new_id}')
+                if new_version != version:
+                    raise ValueError(f'  Package version mismatch: expected {version}, got {new_version}')
+
+                files = {'manifest': manifest, 'sensors': sensors.result()}
+            with zipfile.ZipFile(cache.object(files['sensors']), 'r') as z:
+                if (name := z.testzip()) is not None:
+                    raise ValueError(f'  Damaged archive: {name}')
+            cache.add_release(repo_id, version, files)
+        else:
+            print(f'  {id}: Using cached {version}')
 
         mkdir_clean(dst_path)
-
-        print('  Downloading manifest')
-        response = requests.get(download_url + '/manifest.json', stream=True)
-        response.raise_for_status()
-        with open(config_dst_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=4096):
-                f.write(chunk)
-
-        config = parse_file(config_dst_path).as_dict()
-        new_id = config['pkg'].as_str()
-        new_version = config['version'].as_str()
-        if new_id != id:
-            raise ValueError(f'  Package id mismatch: expected {id}, got {new_id}')
-        if new_version != version:
-            raise ValueError(f'  Package version mismatch: expected {version}, got {new_version}')
-
-        print('  Downloading sensors')
-        archive_path = os.path.join(DIR_TEMP, 'sensors.zip')
-        response = requests.get(download_url + '/sensors.zip', stream=True)
-        response.raise_for_status()
-        with open(archive_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=4096):
-                f.write(chunk)
-
-        print('  Unpacking sensors')
-        with zipfile.ZipFile(archive_path, 'r') as z:
+        shutil.copyfile(cache.object(files['manifest']), config_dst_path)
+        with zipfile.ZipFile(cache.object(files['sensors']), 'r') as z:
             z.extractall(sensors_dst_path)
+        config = load_manifest(config_dst_path)
+        print(f'  {id}: Installed {version}')
     else:
-        print(f'  Already up to date')
+        print(f'  {id}: Already up to date')
 
     return config # type: ignore
 
-def install_package(package: ReadDict) -> ReadDict:
+def install_package(package: PackageSource) -> Manifest:
     """
     Install a sensor package from given source configuration
     """
-    type_ = package['type'].as_str()
-    match type_:
+    match package.type:
         case 'folder':
             return _install_folder(package)
         case 'github':
             return _install_github(package)
         case _:
-            raise TypeError(f'Unknown package source type {type_!r}')
-        
-    return config
+            raise TypeError(f'Unknown package source type {package.type!r}')
 
 def setup_venv(path: str):
     """
@@ -149,15 +366,33 @@ def setup_venv(path: str):
     venv.create('./run/venv', with_pip=True, upgrade_deps=True)
     print('venv created')
 
+def dependency_fingerprint(deps: list[str]) -> str:
+    """
+    Hash of the dependency constraints and the interpreter the venv is created with
+    """
+    value = {'python': sys.version, 'platform': platform.platform(), 'dependencies': sorted(set(deps))}
+    return hashlib.sha256(json.dumps(value).encode()).hexdigest()
+
+def dependencies_unchanged(fingerprint: str) -> bool:
+    try:
+        with open(DEPS_LOCK, 'rt') as f:
+            return f.read().strip() == fingerprint
+    except OSError:
+        return False
+
 def install_dependencies(python: str, deps: list[str]) -> bool:
     """
     Run pip and install the supplied list of dependency constraints
     """
     print('Installing dependencies')
+    if os.path.exists(DEPS_LOCK):
+        os.remove(DEPS_LOCK)
     proc = subprocess.run((python, '-m', 'pip', 'install', *deps), stderr=subprocess.PIPE)
     if proc.returncode:
         print('Failed to install dependencies')
         return False
+    with open(DEPS_LOCK, 'wt') as f:
+        f.write(dependency_fingerprint(deps))
     print('Dependencies installed')
     return True
 
@@ -172,12 +407,12 @@ parser.add_argument('--clean', action='store_true', help='Clean install packages
 
 args = parser.parse_args()
 
-settings = parse_file(args.settings, 'settings').as_dict()
+settings = load_settings(args.settings)
 
 if not os.path.isdir(DIR_RUN):
     os.mkdir(DIR_RUN)
 
-mkdir_clean(DIR_TEMP)
+cache = DownloadCache(DIR_CACHE)
 
 # Create or empty package directory
 if args.clean:
@@ -187,22 +422,18 @@ else:
         os.mkdir(DIR_PACKAGES)
 
 print('Installing sensor packages')
-packages = dict[str, ReadDict]()
-for package in settings['packages'].as_list().iter_dict():
-    config = install_package(package)
-    id = config['pkg'].as_str()
-    packages[id] = config
+packages = dict[str, Manifest]()
+with ThreadPoolExecutor(max_workers=PARALLEL_INSTALLS) as executor:
+    for config in executor.map(install_package, settings.packages):
+        packages[config.pkg] = config
+cache.save()
 
 # Collect used sensors
-used_packages = set[str]()
-for sensor in settings['sensors'].as_list().iter_dict():
-    sensor_id = sensor['type'].as_str()
-    pkg, id = sensor_id.split(':')
-    used_packages.add(pkg)
+used_packages = {sensor.package for sensor in settings.sensors}
 
 # Check if all packages have been installed
 for package_id in used_packages:
-    if package_id not in packages:
+    if package_id not in packages and package_id not in BUILTIN_PACKAGES:
         raise KeyError(f'Missing package {package_id!r}')
 
 # Collect dependencies
@@ -210,7 +441,7 @@ deps = [dep for dep in DEFAULT_DEPS]
 for id, package in packages.items():
     if not os.path.exists(os.path.join(DIR_PACKAGES, id, 'sensors', '__init__.py')):
         raise FileNotFoundError('Missing __init__.py')
-    deps.extend(package['dependencies'].as_list().iter_str())
+    deps.extend(package.dependencies)
 
 match platform.system():
     case 'Linux':
@@ -222,6 +453,9 @@ match platform.system():
 
 if args.clean:
     clean_venv = True
+elif os.path.isdir(DIR_VENV) and dependencies_unchanged(dependency_fingerprint(deps)):
+    print('Dependencies unchanged')
+    clean_venv = False
 else:
     if not os.path.isdir(DIR_VENV):
         setup_venv(DIR_VENV)
@@ -237,11 +471,9 @@ if clean_venv:
         print('Terminating')
         exit(-5)
 
-if os.path.exists(DIR_CORE):
-    shutil.rmtree(DIR_CORE)
-
-shutil.copytree('./core', DIR_CORE)
-shutil.copyfile('./main.py', os.path.join(DIR_RUN, 'main.py'))
+sync_tree('./core', DIR_CORE)
+sync_tree('./schemas', os.path.join(DIR_RUN, 'schemas'))
+sync_file('./main.py', os.path.join(DIR_RUN, 'main.py'))
 
 print('Setup complete')
 
@@ -253,7 +485,7 @@ match platform.system():
     case _:
         raise RuntimeError('Unsupported OS')
 
-subprocess.run(
+proc = subprocess.Popen(
     (
         python_run, './main.py',
         os.path.abspath(args.settings),
@@ -262,4 +494,17 @@ subprocess.run(
     cwd=DIR_RUN
 )
 
+def forward_signal(signum: int, frame: Any):
+    proc.send_signal(signum)
+
+# Ctrl+C and Ctrl+Break reach main.py through the console, wait for it to upload the remaining measurements
+for signum in ('SIGINT', 'SIGBREAK'):
+    if hasattr(signal, signum):
+        signal.signal(getattr(signal, signum), signal.SIG_IGN)
+# Stop and reload requests sent to the launcher are meant for main.py
+for signum in ('SIGTERM', 'SIGHUP'):
+    if hasattr(signal, signum):
+        signal.signal(getattr(signal, signum), forward_signal)
+proc.wait()
+
 print('Terminating')
@@ -1,227 +1,980 @@
+import asyncio
 from collections import deque
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import dataclasses
 from datetime import datetime, timezone
+import gzip
 import importlib
 import json
+import math
 import os
 import platform
+import signal
 from queue import Empty, Queue
 import sys
-from threading import Event, Thread
+import threading
+from threading import Event, Lock, Thread
 import time
 import traceback
+from typing import Any, Callable, Iterable, Sequence
 from uuid import UUID
 
 import psutil
 import requests
+from requests.adapters import HTTPAdapter
 
-from core.classes import Measurement, SensorBase, SensorDef, Status
-from core.config import ReadDict, parse_file
-from core.util import cast, eprint, format_time, get_ip_addr, parse_interval
-
-@dataclass
-class HostConfig:
-    uuid: UUID
-    name: str
-    url: str
-    token: str
-    min_secs: float
-    max_secs: float
-    max_backlog: int
-
-@dataclass
-class SensorConfig:
-    uuid: UUID
-    type: str
-    name: str
-    data: ReadDict
-    secs: float
-
-def measure_loop(sensor: SensorBase, index: int, queue: Queue[tuple[int, Measurement]], secs: float, stop: Event):
-    # TODO: More accurate timing, timeout if a sensor takes too long
+try:
+    import zstandard # type: ignore
+except ImportError:
+    zstandard = None
 
-    try:
-        sensor.start()
-    except Exception as e:
-        eprint(f'ERR: Sensor failed to start: {e}')
-        queue.put((index, Measurement.now(Status.ERROR, error=str(e))))
-        # The sensor is in an invalid state
-        return
-    
-    while not stop.wait(secs):
+from core.aggregate import Aggregator
+from core.classes import Measurement, SensorBase, SensorDef, Status
+from core.deadband import Deadband
+from core.encode import MeasurementEncoder, dumps
+import core.metrics
+from core.metrics import REGISTRY
+from core.openmetrics import MetricsServer, Snapshot
+from core.process import ProcessPool
+from core.retry import CircuitBreaker, RetryPolicy, parse_retry_after
+from core.scheduler import Job, Scheduler
+from core.settings import HostConfig, SensorConfig, Settings, load_settings
+from core.spool import Spool
+from core.util import cast, eprint, format_time, get_ip_addr
+
+# Undelivered measurements, relative to ./run
+DIR_SPOOL = './spool'
+
+# Status codes returned by servers without a batch endpoint
+BATCH_UNSUPPORTED = (404, 405, 501)
+# Status code of request bodies exceeding the server's limit
+PAYLOAD_TOO_LARGE = 413
+# Status codes of temporary server errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Sensor packages shipped with the collector
+BUILTIN_PACKAGES = {
+    'collector': core.metrics,
+}
+
+UPLOAD_REQUESTS = REGISTRY.counter('upload_requests')
+UPLOAD_FAILURES = REGISTRY.counter('upload_failures')
+UPLOAD_DURATION = REGISTRY.histogram('upload_duration', 's')
+BACKLOG_DROPPED = REGISTRY.counter('backlog_dropped')
+
+class SensorTask:
+    """
+    Runs a sensor on the scheduler and enforces its timeout
+    """
+
+    def __init__(self, scheduler: Scheduler, sensor: SensorBase, index: int, label: str, config: SensorConfig, queue: Queue[tuple[int, Measurement]], snapshot: Snapshot | None) -> None:
+        """
+        :param label: Unique label of the sensor's internal metrics
+        """
+        self.scheduler = scheduler
+        self.sensor = sensor
+        self.index = index
+        self.label = label
+        self.config = config
+        self.queue = queue
+        self.snapshot = snapshot
+        self.lock = Lock()
+        self.running = 0
+        """Id of the measurement in flight, 0 if there is none"""
+        self.overdue = False
+        """Whether the measurement in flight has timed out"""
+        self.count = 0
+        self.timeouts = 0
+        """Number of consecutive timeouts"""
+        self.quarantined_until = 0.0
+        self.started = False
+        self.stopped = False
+        self.job: Job | None = None
+        self.measuring = Lock()
+        """Held while the sensor is measured"""
+        self.duration = REGISTRY.histogram('measure_duration', 's', label)
+        self.timeout_count = REGISTRY.counter('measure_timeouts', '', label)
+
+    def start(self) -> bool:
         try:
-            result = sensor.measure()
+            self.sensor.start()
         except Exception as e:
-            trace = traceback.format_tb(e.__traceback__) if debug else None
-            result = Measurement.now(Status.ERROR, error=str(e), trace=trace)
-
-        queue.put((index, result))
-
-def _send_measurement(url: str, token: str, config: SensorConfig, value: Measurement):
-    metrics = []
-    for metric in value.metrics:
-        # Ignore metrics with invalid JSON
+            eprint(f'ERR: Sensor failed to start: {e}')
+            self._emit(Measurement.now(Status.ERROR, error=str(e)))
+            # The sensor is in an invalid state
+            return False
+        self.started = True
+        return True
+
+    def schedule(self):
+        if not self.stopped and self.start():
+            self.job = self.scheduler.add(self.config.secs, self.measure, skipped=self.skip)
+
+    def stop(self):
+        """
+        Stop measuring. The sensor is stopped once a measurement in progress has finished
+        """
+        self.stopped = True
+        if self.job is not None:
+            self.job.cancel()
+        self.scheduler.submit(self._stop)
+
+    def _stop(self):
+        with self.measuring:
+            try:
+                self.sensor.stop()
+            except Exception as e:
+                eprint(f'ERR: Sensor failed to stop: {e}')
+
+    def begin(self) -> int:
+        """
+        Mark a measurement as running and arm its timeout
+
+        :returns: Id of the measurement, 0 if the sensor is quarantined
+        """
+        if time.monotonic() < self.quarantined_until:
+            return 0
+
+        with self.lock:
+            self.count += 1
+            current = self.running = self.count
+        if self.config.timeout is not None:
+            self.scheduler.call_later(self.config.timeout, lambda: self._expire(current))
+        return current
+
+    def finish(self, current: int, result: Measurement, duration: float):
+        self.duration.observe(duration)
+        with self.lock:
+            self.overdue = False
+            # A timeout has already been reported for this measurement
+            if self.running != current:
+                return
+            self.running = 0
+            self.timeouts = 0
+        self._emit(result)
+
+    def measure(self):
+        current = self.begin()
+        if not current:
+            return
+
+        begin = time.perf_counter()
         try:
-            metrics.append(metric.toJSON())
+            with self.measuring:
+                result = self.sensor.measure()
         except Exception as e:
-            eprint(f'ERR: Serializing metric failed: {e}')
-
-    headers = {'Authorization': 'Bearer ' + token}
-    data = {
-        'time': format_time(value.time),
-        'sensorId': str(config.uuid),
-        'message': config.name,
-        'sensorHealthState': value.status,
-        'metrics': metrics,
-    }
-    if value.error is not None:
-        data['error'] = value.error
-    if value.trace is not None:
-        data['trace'] = value.trace
-    
-    try:
-        if debug:
-            print('sending to', repr(url), json.dumps(data, indent='  '))
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-    except Exception as e:
-        eprint(f'ERR: Upload failed: {e}')
-
-def _send_machine_data(url: str, token: str, name: str):
-    boot_time = datetime.fromtimestamp(psutil.boot_time(), tz=timezone.utc)
-
-    headers = {'Authorization': 'Bearer ' + token}
-    data = {
-        'ipAddress': get_ip_addr(),
-        'hostName': name,
-        'domain': os.environ.get('userdomain', None),
-        'operatingSystem': platform.system(),
-        'osVersion': platform.release(),
-        'bootDateTime': format_time(boot_time),
-    }
+            result = _error(e)
+        self.finish(current, result, time.perf_counter() - begin)
+
+    def skip(self):
+        """
+        Called for ticks skipped while a measurement is in flight.
+        Reports another timeout if it already timed out, so a hung sensor keeps reporting and can be quarantined
+        """
+        with self.lock:
+            if not self.overdue or time.monotonic() < self.quarantined_until:
+                return
+        self._timeout(f'Measurement still running after {self.config.timeout}s')
+
+    def _expire(self, current: int):
+        with self.lock:
+            if self.running != current:
+                return
+            self.running = 0
+            self.overdue = True
+        self._timeout(f'Measurement took longer than {self.config.timeout}s')
+
+    def _timeout(self, error: str):
+        with self.lock:
+            self.timeouts += 1
+            quarantine = 0 < self.config.quarantine_after <= self.timeouts
+            if quarantine:
+                self.timeouts = 0
+                self.quarantined_until = time.monotonic() + self.config.quarantine_secs
+
+        self.timeout_count.inc()
+        if quarantine:
+            error += f', sensor quarantined for {self.config.quarantine_secs}s'
+            eprint(f'WARN: Sensor {self.config.name!r} timed out repeatedly, quarantined')
+        self._emit(Measurement.now(Status.TIMEOUT, error=error))
+
+    def _emit(self, result: Measurement):
+        self.queue.put((self.index, result))
+        if self.snapshot is not None:
+            self.snapshot.update(self.index, result)
+
+class SensorGroup:
+    """
+    Sensors of the same type and interval, measured by a single `measure_group()` call.
+    Timeouts and quarantine still apply to each sensor on its own
+    """
+
+    def __init__(self, scheduler: Scheduler, tasks: list[SensorTask]) -> None:
+        self.scheduler = scheduler
+        self.tasks = sorted(tasks, key=lambda task: task.index)
+        self.job: Job | None = None
+
+    def schedule(self):
+        self.tasks = [task for task in self.tasks if not task.stopped and (task.started or task.start())]
+        if self.tasks:
+            self.job = self.scheduler.add(self.tasks[0].config.secs, self.measure, skipped=self.skip)
+
+    def stop(self):
+        """
+        Stop measuring, the sensors themselves are not stopped
+        """
+        if self.job is not None:
+            self.job.cancel()
+
+    def skip(self):
+        for task in self.tasks:
+            task.skip()
+
+    def measure(self):
+        running = [(task, current) for task in self.tasks if (current := task.begin())]
+        if not running:
+            return
+
+        begin = time.perf_counter()
+        try:
+            sensors = [task.sensor for task, _ in running]
+            # Locks are taken in the order of the sensor index, the same sensor may be in an old and a new group
+            with contextlib.ExitStack() as stack:
+                for task, _ in running:
+                    stack.enter_context(task.measuring)
+                results = sensors[0].measure_group(sensors)
+            if len(results) != len(sensors):
+                raise ValueError(f'measure_group() returned {len(results)} measurements for {len(sensors)} sensors')
+        except Exception as e:
+            results = [_error(e)] * len(running)
+        duration = time.perf_counter() - begin
+        for (task, current), result in zip(running, results):
+            task.finish(current, result, duration)
 
-    try:
+def _error(e: Exception) -> Measurement:
+    trace = traceback.format_tb(e.__traceback__) if debug else None
+    return Measurement.now(Status.ERROR, error=str(e), trace=trace)
+
+SensorKey = tuple[UUID, int]
+"""Sensor uuid and its number of previous occurrences in the settings, as uuids are not always unique"""
+
+def _keys(configs: Sequence[SensorConfig]) -> dict[SensorKey, SensorConfig]:
+    counts = dict[UUID, int]()
+    keys = dict[SensorKey, SensorConfig]()
+    for config in configs:
+        count = counts[config.uuid] = counts.get(config.uuid, -1) + 1
+        keys[config.uuid, count] = config
+    return keys
+
+def _label(key: SensorKey) -> str:
+    uuid, count = key
+    return f'{uuid}#{count}' if count else str(uuid)
+
+def _same(a: SensorConfig, b: SensorConfig) -> bool:
+    return a.data.value == b.data.value and dataclasses.replace(a, data=b.data) == b
+
+class Sensors:
+    """
+    Running sensors, created from the sensor configs and updated when the settings change.
+    Sensors are identified by index in `configs`, which is only ever appended to,
+    so measurements of removed sensors can still be uploaded
+    """
+
+    def __init__(self, scheduler: Scheduler, queue: Queue[tuple[int, Measurement]], snapshot: Snapshot | None, process_workers: int) -> None:
+        self.scheduler = scheduler
+        self.queue = queue
+        self.snapshot = snapshot
+        self.process_workers = process_workers
+        self.pool: ProcessPool | None = None
+        self.defs = dict[str, SensorDef]()
+        self.pkgs = set[str]()
+        self.configs = list[SensorConfig]()
+        self.loaded = dict[SensorKey, SensorConfig]()
+        """Configs as loaded from the settings"""
+        self.tasks = dict[SensorKey, SensorTask]()
+        self.groups = dict[tuple[str, float], SensorGroup]()
+
+    def load_packages(self, configs: Iterable[SensorConfig]):
+        """
+        Load the sensor definitions of all packages used by the given sensors
+        """
+        for pkg in sorted({config.package for config in configs} - self.pkgs):
+            print('Loading package', pkg)
+            mod = BUILTIN_PACKAGES[pkg] if pkg in BUILTIN_PACKAGES else importlib.import_module(f'packages.{pkg}.sensors')
+            mod_sensors = cast('SENSORS', mod.SENSORS, list)
+            for sensor in mod_sensors:
+                sensor = cast('SENSORS[i]', sensor, SensorDef)
+                self.defs[pkg + ':' + sensor.id] = sensor
+            self.pkgs.add(pkg)
+
+    def _create(self, key: SensorKey, config: SensorConfig) -> SensorTask:
+        sensor = self.defs[config.type]
+        process = config.process and config.package not in BUILTIN_PACKAGES
+        config = dataclasses.replace(config, process=process, batch=sensor.batch, group=sensor.group and not process)
+        if config.process:
+            if self.pool is None:
+                self.pool = ProcessPool(self.process_workers)
+            inst: SensorBase = self.pool.sensor(config.type, config.data.value, config.timeout)
+        else:
+            sensor_settings = sensor.settings.deserialize(config.data)
+            inst = sensor.sensor(sensor_settings)
+
+        index = len(self.configs)
+        self.configs.append(config)
+        if self.snapshot is not None:
+            self.snapshot.register(index, {'sensor': config.name, 'sensor_id': str(config.uuid), 'type': config.type})
+        return SensorTask(self.scheduler, inst, index, _label(key), config, self.queue, self.snapshot)
+
+    def _remove(self, key: SensorKey):
+        task = self.tasks.pop(key)
+        del self.loaded[key]
+        task.stop()
+        REGISTRY.remove(task.label)
+        if self.snapshot is not None:
+            self.snapshot.unregister(task.index)
+
+    def update(self, configs: Sequence[SensorConfig], strict: bool = False) -> tuple[int, int, int]:
+        """
+        Start, stop and replace sensors so they match the given configs.
+        Unchanged sensors keep running
+
+        :param strict: Raise if a sensor can't be created instead of skipping it
+        :returns: Number of added, changed and removed sensors
+        """
+        new = _keys(configs)
+        removed = [key for key in self.loaded if key not in new]
+        changed = [key for key, config in new.items() if key in self.loaded and not _same(self.loaded[key], config)]
+        added = [key for key in new if key not in self.loaded]
+
+        groups = set[tuple[str, float]]()
+        for key in removed + changed:
+            config = self.tasks[key].config
+            if config.group:
+                groups.add((config.type, config.secs))
+            self._remove(key)
+
+        for key in changed + added:
+            config = new[key]
+            try:
+                self.load_packages((config,))
+                task = self._create(key, config)
+            except Exception as e:
+                if strict:
+                    raise
+                eprint(f'ERR: Sensor {config.name!r} could not be created: {e}')
+                continue
+            self.tasks[key] = task
+            self.loaded[key] = config
+            if task.config.group:
+                groups.add((task.config.type, task.config.secs))
+            else:
+                self.scheduler.submit(task.schedule)
+
+        # Groups with new or removed sensors are replaced
+        for group_key in groups:
+            if group_key in self.groups:
+                self.groups.pop(group_key).stop()
+            tasks = [
+                task for task in self.tasks.values()
+                if task.config.group and (task.config.type, task.config.secs) == group_key
+            ]
+            if tasks:
+                group = self.groups[group_key] = SensorGroup(self.scheduler, tasks)
+                self.scheduler.submit(group.schedule)
+
+        return len(added), len(changed), len(removed)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+class BatchUnsupported(Exception):
+    """
+    The server does not support batch uploads
+    """
+
+class Uploader:
+    """
+    Sends measurements and machine data to the API.
+    Connections are pooled and reused across upload cycles and heartbeats
+    """
+
+    def __init__(self, host: HostConfig, stop: Event) -> None:
+        self.host = host
+        self.stop = stop
+        self.retry = RetryPolicy(host.retries, host.retry_secs, host.retry_max_secs)
+        self.breaker = CircuitBreaker(host.breaker_threshold, host.breaker_reset_secs)
+        self.url_machine = host.url + '/Host/machine-data/' + str(host.uuid)
+        self.url_measure = host.url + '/Collector'
+        self.url_batch = host.url + '/Collector/batch'
+        self.batch_size = host.batch_size
+        self.timeout = (host.connect_timeout, host.read_timeout)
+        self.deadline: float | None = None
+        """Monotonic time after which no more requests are sent, used when stopping"""
+
+        self.compression = host.compression
+        if self.compression == 'zstd':
+            if zstandard is None:
+                eprint('WARN: zstandard is not installed, using gzip compression')
+                self.compression = 'gzip'
+        # Compressors are not thread safe, each upload lane gets its own
+        self._local = threading.local()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(host.pool_size, host.concurrency + 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Authorization'] = 'Bearer ' + host.token
+        if not host.keep_alive:
+            self.session.headers['Connection'] = 'close'
+
+        # Host facts that don't change while the collector is running
+        self.machine_static = {
+            'hostName': host.name,
+            'domain': os.environ.get('userdomain', None),
+            'operatingSystem': platform.system(),
+            'osVersion': platform.release(),
+            'bootDateTime': format_time(datetime.fromtimestamp(psutil.boot_time(), tz=timezone.utc)),
+        }
+        self.interfaces: int | None = None
+        """Hash of the network interface addresses the ip address was resolved for"""
+        self.ip_addr: str | None = None
+        self.machine_sent: dict[str, Any] | None = None
+        """Machine data last accepted by the server"""
+        self.machine_sent_at = 0.0
+        self.machine_checked_at = 0.0
+        """Monotonic time the last heartbeat started"""
+
+    def close(self):
+        self.session.close()
+
+    def _encode(self, data: Any) -> tuple[bytes, dict[str, str]]:
+        """
+        Serialize a request body, compressing it if it is large enough
+
+        :returns: Body and headers
+        """
+        body = dumps(data)
+        headers = {'Content-Type': 'application/json'}
+        if self.compression == 'none' or len(body) < self.host.compression_threshold:
+            return body, headers
+
+        if self.compression == 'zstd' and zstandard is not None:
+            zstd = getattr(self._local, 'zstd', None)
+            if zstd is None:
+                zstd = self._local.zstd = zstandard.ZstdCompressor()
+            body = zstd.compress(body)
+        else:
+            body = gzip.compress(body, compresslevel=6)
+        headers['Content-Encoding'] = self.compression
+        return body, headers
+
+    def _request(self, method: str, url: str, data: Any) -> requests.Response | None:
+        """
+        Send a request, retrying on connection errors and temporary server errors
+
+        :returns: The response, or None if the request failed or the circuit breaker is open
+        """
         if debug:
             print('sending to', repr(url), json.dumps(data, indent='  '))
-        response = requests.patch(url, headers=headers, json=data)
-        response.raise_for_status()
-    except Exception as e:
-        print(f'ERR: Upload failed: {e}')
-
-def upload_loop(host: HostConfig, configs: list[SensorConfig], queue: Queue[tuple[int, Measurement]], stop: Event):
-    # TODO: More accurate timing
+        body, headers = self._encode(data)
 
-    url_machine = host.url + '/Host/machine-data/' + str(host.uuid)
-    url_measure = host.url + '/Collector'
+        attempt = 0
+        while True:
+            timeout = self.timeout
+            if self.deadline is not None:
+                remaining = self.deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+            if not self.breaker.allow():
+                break
+            attempt += 1
+            retry_after = None
+            UPLOAD_REQUESTS.inc()
+            begin = time.perf_counter()
+            try:
+                response = self.session.request(method, url, data=body, headers=headers, timeout=timeout)
+                UPLOAD_DURATION.observe(time.perf_counter() - begin)
+                if response.status_code not in RETRY_STATUS:
+                    if self.breaker.open_until is not None:
+                        print('API reachable again, resuming uploads')
+                    self.breaker.success()
+                    return response
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                error = f'{response.status_code} {response.reason}'
+            except requests.RequestException as e:
+                error = str(e)
+
+            eprint(f'ERR: Upload failed: {error}')
+            UPLOAD_FAILURES.inc()
+            if retry_after is not None and retry_after > self.retry.max_secs:
+                self.breaker.trip(retry_after)
+            else:
+                self.breaker.failure()
+            if self.breaker.is_open():
+                eprint('WARN: API unavailable, pausing uploads')
+                break
+            if attempt > self.retry.retries:
+                break
 
-    _send_machine_data(url_machine, host.token, host.name)
-    last = time.time()
-    to_send = dict[int, deque[Measurement]]()
-    while not stop.wait(host.min_secs):
-        # Batch measurements
+            delay = self.retry.delay(attempt)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            if self.stop.wait(delay):
+                break
+        return None
+
+    def send_measurement(self, data: dict[str, Any]) -> bool:
+        """
+        :returns: Whether the measurement was delivered
+        """
+        response = self._request('POST', self.url_measure, data)
+        if response is None:
+            return False
+        if not response.ok:
+            # Rejected by the server, sending it again would not help
+            eprint(f'ERR: Upload rejected: {response.status_code} {response.reason}')
+        return True
+
+    def send_batch(self, batch: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """
+        Upload multiple measurements in a single request.
+        Batches that are too large are split, other rejected batches are sent individually,
+        so a single invalid measurement doesn't drop the whole batch
+
+        :returns: Measurements that could not be delivered
+        :raises BatchUnsupported: If the server does not support batch uploads
+        """
+        response = self._request('POST', self.url_batch, batch)
+        if response is None:
+            return batch
+        if response.status_code in BATCH_UNSUPPORTED:
+            raise BatchUnsupported()
+        if response.ok:
+            return []
+        if len(batch) == 1:
+            # Rejected by the server, sending it again would not help
+            eprint(f'ERR: Upload rejected: {response.status_code} {response.reason}')
+            return []
+        if response.status_code == PAYLOAD_TOO_LARGE:
+            half = len(batch) // 2
+            return self.send_batch(batch[:half]) + self.send_batch(batch[half:])
+        eprint(f'WARN: Batch rejected: {response.status_code} {response.reason}, sending measurements individually')
+        return [data for data in batch if not self.send_measurement(data)]
+
+    def _machine_data(self) -> dict[str, Any]:
+        interfaces = hash(tuple(
+            (name, tuple(addr.address for addr in addrs))
+            for name, addrs in sorted(psutil.net_if_addrs().items())
+        ))
+        if interfaces != self.interfaces or self.ip_addr is None:
+            self.interfaces = interfaces
+            self.ip_addr = get_ip_addr()
+        return {'ipAddress': self.ip_addr, **self.machine_static}
+
+    def send_machine_data(self):
+        """
+        Send machine data if it changed or was last sent more than `machine_data_refresh` ago
+        """
+        # Times are taken before the request, so its duration doesn't delay the next refresh
+        now = self.machine_checked_at = time.monotonic()
+        data = self._machine_data()
+        if data == self.machine_sent and now - self.machine_sent_at < self.host.machine_data_refresh_secs:
+            return
+
+        response = self._request('PATCH', self.url_machine, data)
+        if response is not None and not response.ok:
+            eprint(f'ERR: Upload rejected: {response.status_code} {response.reason}')
+        elif response is not None:
+            self.machine_sent = data
+            self.machine_sent_at = now
+
+    def upload(self, pending: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        """
+        Upload measurements, in batches if the server supports it
+
+        :returns: Measurements that could not be delivered
+        """
+        failed = list[dict[str, Any]]()
+        if self.batch_size > 0:
+            while pending:
+                batch = pending[:self.batch_size]
+                try:
+                    failed.extend(self.send_batch(batch))
+                except BatchUnsupported:
+                    eprint('WARN: Server does not support batch uploads, sending measurements individually')
+                    self.batch_size = 0
+                    break
+                pending = pending[len(batch):]
+
+        for data in pending:
+            if not self.send_measurement(data):
+                failed.append(data)
+        return failed
+
+def _open_spool(host: HostConfig) -> Spool | None:
+    if host.spool_max_bytes <= 0:
+        return None
+    try:
+        spool = Spool(DIR_SPOOL, host.spool_max_bytes, host.spool_max_secs)
+    except OSError as e:
+        eprint(f'ERR: Spool could not be opened, undelivered measurements are dropped: {e}')
+        return None
+    REGISTRY.gauge('spool_unread', spool.unread, 'B')
+    return spool
+
+class Backlog:
+    """
+    Measurements waiting for upload, per sensor.
+    Applies aggregation, deadband filtering and the backlog limits of each sensor
+    """
+
+    def __init__(self, host: HostConfig, configs: list[SensorConfig]) -> None:
+        self.max_backlog = host.max_backlog
+        self.max_secs = host.max_secs
+        self.configs = configs
+        """Configs of all sensors by index, sensors added while running are appended"""
+        self.aggregators = list[Aggregator | None]()
+        self.deadbands = list[Deadband | None]()
+        self.items = dict[int, deque[Measurement]]()
+
+    def _grow(self):
+        """
+        Create the state of sensors added since the last call
+        """
+        for config in self.configs[len(self.aggregators):]:
+            self.aggregators.append(
+                Aggregator(config.aggregate_secs, config.aggregate_functions) if config.aggregate_secs is not None else None
+            )
+            self.deadbands.append(
+                Deadband(config.deadband, self.max_secs) if config.deadband is not None else None
+            )
+
+    def _append(self, index: int, item: Measurement):
+        deadband = self.deadbands[index]
+        if deadband is not None and not deadband.changed(item):
+            return
+        if not self.configs[index].batch:
+            # Only the latest measurement is relevant
+            self.items[index] = deque((item,))
+            return
+
+        if index not in self.items:
+            self.items[index] = deque()
+        # Remove old measurements
+        if len(self.items[index]) >= self.max_backlog:
+            del self.items[index][0]
+            BACKLOG_DROPPED.inc()
+        self.items[index].append(item)
+
+    def collect(self, queue: Queue[tuple[int, Measurement]], final: bool = False):
+        """
+        Move measurements from the queue to the backlog.
+        Measurements of aggregated sensors are only added once their window has ended
+
+        :param final: Also add aggregates of windows that have not ended yet
+        """
         while True:
             try:
                 index, item = queue.get_nowait()
-                if index not in to_send:
-                    to_send[index] = deque()
-                # Remove old measurements
-                if len(to_send[index]) >= host.max_backlog:
-                    del to_send[index][0]
-                to_send[index].append(item)
             except Empty:
                 break
+            if index >= len(self.aggregators):
+                self._grow()
+            aggregator = self.aggregators[index]
+            if aggregator is not None:
+                item = aggregator.add(item)
+                if item is None:
+                    continue
+            self._append(index, item)
+
+        now = math.inf if final else time.time()
+        for index, aggregator in enumerate(self.aggregators):
+            if aggregator is not None and (item := aggregator.flush(now)) is not None:
+                self._append(index, item)
+
+    def take(self) -> dict[int, deque[Measurement]]:
+        """
+        Remove and return all measurements
+        """
+        items, self.items = self.items, {}
+        return items
+
+Upload = Callable[[list[dict[str, Any]]], list[dict[str, Any]]]
+"""Uploads measurements and returns the ones that could not be delivered"""
+
+class Delivery:
+    """
+    Moves measurements from the queue to the API, shared by both upload engines.
+    Undelivered measurements are kept in the spool and replayed once the API is reachable again
+    """
+
+    def __init__(self, host: HostConfig, configs: list[SensorConfig], queue: Queue[tuple[int, Measurement]], uploader: Uploader) -> None:
+        self.host = host
+        self.queue = queue
+        self.uploader = uploader
+        self.backlog = Backlog(host, configs)
+        self.encoders = list[MeasurementEncoder]()
+        self.spool = _open_spool(host)
+
+    def _pending(self) -> list[dict[str, Any]]:
+        """
+        Take all measurements from the backlog, encoded for upload
+        """
+        for config in self.backlog.configs[len(self.encoders):]:
+            self.encoders.append(MeasurementEncoder(str(config.uuid), config.name))
+        return [
+            self.encoders[index].encode(value)
+            for index, values in self.backlog.take().items()
+            for value in values
+        ]
+
+    def cycle(self, upload: Upload):
+        """
+        Upload the measurements collected since the previous cycle
+        """
+        self.backlog.collect(self.queue)
+        failed = upload(self._pending())
+        spool = self.spool
+        if spool is None:
+            return
+        try:
+            if failed:
+                # Keep undelivered measurements on disk until the API is reachable again
+                spool.append(failed)
+            elif spool.unread():
+                values, cursor = spool.read(self.host.spool_replay)
+                failed = upload(values)
+                if len(failed) < len(values):
+                    spool.commit(cursor)
+                    spool.append(failed)
+        except Exception as e:
+            # e.g. a full disk, uploads go on and measurements that could not be stored are dropped
+            eprint(f'ERR: Spool failed: {e}')
+
+    def finish(self, upload: Upload):
+        """
+        Upload the remaining measurements before stopping, within the shutdown timeout
+        """
+        self.uploader.deadline = time.monotonic() + self.host.shutdown_secs
+        self.backlog.collect(self.queue, final=True)
+        pending = self._pending()
+        failed = upload(pending)
+        if failed and self.spool is not None:
+            try:
+                self.spool.append(failed)
+            except Exception as e:
+                eprint(f'ERR: Spool failed, dropping {len(failed)} measurement(s): {e}')
+        print(f'Uploaded {len(pending) - len(failed)} of {len(pending)} remaining measurements')
+
+def _lanes(items: list[dict[str, Any]], count: int) -> list[list[dict[str, Any]]]:
+    """
+    Split measurements into lanes that can be uploaded concurrently.
+    All measurements of a sensor end up in the same lane, in their original order
+    """
+    lanes = [list[dict[str, Any]]() for _ in range(count)]
+    for data in items:
+        lanes[hash(data['sensorId']) % count].append(data)
+    return [lane for lane in lanes if lane]
+
+def _upload_lanes(executor: ThreadPoolExecutor, uploader: Uploader, count: int) -> Upload:
+    """
+    Upload in up to `count` concurrent lanes
+    """
+    def upload(items: list[dict[str, Any]]) -> list[dict[str, Any]]:
+        results = executor.map(uploader.upload, _lanes(items, count))
+        return [data for failed in results for data in failed]
+    return upload
+
+def upload_loop(host: HostConfig, configs: list[SensorConfig], queue: Queue[tuple[int, Measurement]], stop: Event):
+    # TODO: More accurate timing
 
+    uploader = Uploader(host, stop)
+    delivery = Delivery(host, configs, queue, uploader)
+
+    uploader.send_machine_data()
+    while not stop.wait(host.min_secs):
         # Heartbeat
-        if time.time() - last > host.max_secs:
-            last = time.time()
-            _send_machine_data(url_machine, host.token, host.name)
-        
+        if time.monotonic() - uploader.machine_checked_at >= host.max_secs:
+            uploader.send_machine_data()
+
         # Upload data
-        # TODO: Add batching to API
-        for index, values in to_send.items():
-            for value in values:
-                _send_measurement(url_measure, host.token, configs[index], value)
-        to_send = {}
+        delivery.cycle(uploader.upload)
+
+    # Upload the remaining measurements before stopping
+    with ThreadPoolExecutor(max_workers=host.concurrency, thread_name_prefix='upload') as executor:
+        delivery.finish(_upload_lanes(executor, uploader, host.concurrency))
+    uploader.close()
+
+async def upload_loop_async(host: HostConfig, configs: list[SensorConfig], queue: Queue[tuple[int, Measurement]], stop: Event):
+    """
+    Upload engine with multiple requests in flight.
+    Requests are sent by the pooled session on a bounded executor,
+    heartbeats run independently so slow uploads never delay them
+    """
+    executor = ThreadPoolExecutor(max_workers=host.concurrency, thread_name_prefix='upload')
+    uploader = Uploader(host, stop)
+    delivery = Delivery(host, configs, queue, uploader)
+    upload = _upload_lanes(executor, uploader, host.concurrency)
+
+    async def wait(secs: float) -> bool:
+        return await asyncio.to_thread(stop.wait, secs)
+
+    async def heartbeat():
+        while True:
+            # Not on the upload executor, whose workers may all be busy with slow lanes
+            await asyncio.to_thread(uploader.send_machine_data)
+            if await wait(host.max_secs):
+                break
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    while not await wait(host.min_secs):
+        await asyncio.to_thread(delivery.cycle, upload)
+    await heartbeat_task
+
+    await asyncio.to_thread(delivery.finish, upload)
+    executor.shutdown()
+    uploader.close()
 
 # This should be set by launcher.py
 settings_file = sys.argv[1]
 debug = sys.argv[2] == 'debug'
 
-settings = parse_file(settings_file, 'settings').as_dict()
-
-# Load config file
-uuid = UUID(settings['uuid'].as_str())
-url = settings['url'].as_str()
-name = settings['name'].as_str(platform.node())
-token = settings['token'].as_str()
-upload = settings['upload'].as_dict()
-min_upload_secs = parse_interval(upload['min_interval'].as_str())
-max_upload_secs = parse_interval(upload['max_interval'].as_str())
-max_backlog = upload['max_backlog'].as_int()
-
-host = HostConfig(uuid, name, url, token, min_upload_secs, max_upload_secs, max_backlog)
-
-
-# Load sensor settings
-pkgs = set[str]()
-configs = list[SensorConfig]()
-for sensor in settings['sensors'].as_list().iter_dict():
-    uuid = UUID(sensor['uuid'].as_str())
-    type = sensor['type'].as_str()
-    name = sensor['name'].as_str()
-    data = sensor['settings'].as_dict()
-
-    pkg, id = type.split(':')
-    pkgs.add(pkg)
-    secs = parse_interval(sensor['interval'].as_str())
-    if secs < 0.05:
-        raise ValueError('Interval must be >= 50ms')
-
-    configs.append(SensorConfig(uuid, type, name, data, secs))
-
-# Load sensor python scripts
-sensors = dict[str, SensorDef]()
-for pkg in pkgs:
-    print('Loading package', pkg)
-    mod = importlib.import_module(f'packages.{pkg}.sensors')
-    mod_sensors = cast('SENSORS', mod.SENSORS, list)
-    for sensor in mod_sensors:
-        sensor = cast('SENSORS[i]', sensor, SensorDef)
-        sensors[pkg + ':' + sensor.id] = sensor
-
-print('Loaded', len(sensors), 'sensor(s) from', len(pkgs), 'package(s)')
-
-# Instantiate sensor scripts
-print('Creating', len(configs), 'sensors')
-insts = list[SensorBase]()
+settings = load_settings(settings_file)
+host = settings.host
+
+# Schedule measurements on a shared worker pool
+queue = Queue[tuple[int, Measurement]]()
+threads = list[Thread]()
+event_stop = Event()
+scheduler = Scheduler(settings.workers)
+REGISTRY.gauge('queue_size', queue.qsize)
+REGISTRY.gauge('threads', threading.active_count)
+snapshot = None
+server = None
+metrics_server = settings.metrics_server
+if metrics_server is not None:
+    snapshot = Snapshot(REGISTRY)
+    server = MetricsServer(snapshot, *metrics_server)
+    server.start()
+    print('Serving metrics on', f'http://{metrics_server[0]}:{metrics_server[1]}/metrics')
+
+sensors = Sensors(scheduler, queue, snapshot, settings.process_workers)
 try:
-    for config in configs:
-        sensor = sensors[config.type]
-        settings = sensor.settings.deserialize(config.data)
-        insts.append(sensor.sensor(settings))
+    # Load sensor python scripts
+    sensors.load_packages(settings.sensors)
+    print('Loaded', len(sensors.defs), 'sensor(s) from', len(sensors.pkgs), 'package(s)')
+
+    # Instantiate sensor scripts
+    print('Creating', len(settings.sensors), 'sensors')
+    sensors.update(settings.sensors, strict=True)
 except Exception as e:
     print('Sensors failed to start, aborting')
+    if server is not None:
+        server.stop()
+    sensors.close()
     raise e
 
-# Run measuring loop on a different thread
-queue = Queue[tuple[int, Measurement]]()
-threads = list[Thread]()
-event_stop = Event()
-for index, inst in enumerate(insts):
-    thread = Thread(target=measure_loop, args=(inst, index, queue, configs[index].secs, event_stop))
-    thread.start()
+thread = Thread(target=scheduler.run)
+thread.start()
+threads.append(thread)
 
-thread = Thread(target=upload_loop, args=(host, configs, queue, event_stop))
+# Measurements of removed sensors are still uploaded, sensors.configs is shared with the upload loop
+if host.engine == 'async':
+    thread = Thread(target=lambda: asyncio.run(upload_loop_async(host, sensors.configs, queue, event_stop)))
+else:
+    thread = Thread(target=upload_loop, args=(host, sensors.configs, queue, event_stop))
 thread.start()
 
 print('Running')
 
-input('Press Enter to stop\n')
+# Settings that are only applied when the collector is restarted
+RESTART_SETTINGS = ('host', 'packages', 'workers', 'metrics_server', 'process_workers')
 
+def reload_settings(current: Settings) -> Settings:
+    """
+    Load the settings file again and apply changed sensors
+
+    :returns: The settings in effect
+    """
+    print('Reloading settings')
+    try:
+        new = load_settings(settings_file)
+    except (ValueError, OSError) as e:
+        eprint(f'ERR: Settings not reloaded: {e}')
+        return current
+
+    restart = {name: getattr(current, name) for name in RESTART_SETTINGS if getattr(new, name) != getattr(current, name)}
+    if restart:
+        eprint(f'WARN: Changes to {", ".join(restart)} are applied after a restart')
+    added, changed, removed = sensors.update(new.sensors)
+    print('Sensors:', added, 'added,', changed, 'changed,', removed, 'removed')
+    return dataclasses.replace(new, **restart)
+
+def settings_version() -> tuple[int, int] | None:
+    try:
+        stat = os.stat(settings_file)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+# Stop on SIGTERM, Ctrl+C or Enter, reload on SIGHUP
+shutdown = Event()
+reload = Event()
+
+def stop_signal(signum: int, frame: Any):
+    print('Received', signal.Signals(signum).name)
+    shutdown.set()
+
+def reload_signal(signum: int, frame: Any):
+    reload.set()
+
+def stop_input():
+    try:
+        input('Press Enter to stop\n')
+    except EOFError:
+        # No console, e.g. when running as a service
+        return
+    shutdown.set()
+
+for signum in ('SIGINT', 'SIGTERM', 'SIGBREAK'):
+    if hasattr(signal, signum):
+        signal.signal(getattr(signal, signum), stop_signal)
+if hasattr(signal, 'SIGHUP'):
+    signal.signal(signal.SIGHUP, reload_signal)
+Thread(target=stop_input, daemon=True).start()
+
+version = settings_version()
+checked = time.monotonic()
+# Wait with a timeout, so signals are handled on Windows too
+while not shutdown.wait(1):
+    if settings.reload_secs is not None and time.monotonic() - checked >= settings.reload_secs:
+        checked = time.monotonic()
+        if settings_version() != version:
+            reload.set()
+    if reload.is_set():
+        reload.clear()
+        version = settings_version()
+        settings = reload_settings(settings)
+
+print('Stopping')
+# The upload loop flushes the backlog right away, measurements still in progress are not waited for
 event_stop.set()
+finished = scheduler.stop(0)
 print('Waiting for threads to join')
 thread.join()
 for thread in threads:
     thread.join()
+if server is not None:
+    server.stop()
+sensors.close()
 
 print('Stopped')
+if not finished and not scheduler.stop(1):
+    # Hung sensors would keep the interpreter from exiting, as it joins all worker threads
+    eprint('WARN: Sensors still measuring, exiting without waiting for them')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)